@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Run from the repository root: python -m benchmarks.bench_pathing
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from utils.pathing import Graph
+from utils.robot import MOVE_FWD_TIME, TURN_LFT_TIME, TURN_RGT_TIME
+
+SIZES = ["12x15", "50x50", "100x100", "300x300", "1000x1000"]
+DENSITIES = [0.0, 0.05, 0.2]
+
+
+def timed(function, repeat: int) -> float:
+    # Median of several runs, in seconds
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def make_obstacles(length: int, width: int, density: float, rng: random.Random):
+    inner = [i * width + j for i in range(1, length - 1) for j in range(1, width - 1)]
+    # Graph inflates every obstacle by its 4 neighbours
+    return rng.sample(inner, int(len(inner) * density / 5))
+
+
+def pick_route(graph: Graph, rng: random.Random):
+    free = [cell for cell in range(len(graph.cells)) if graph.cells[cell]]
+    for _ in range(20):
+        start, dest = rng.sample(free, 2)
+        try:
+            graph.build_path(graph.get_node_by_id(start), graph.get_node_by_id(dest))
+        except KeyError:
+            continue
+        return graph.get_node_by_id(start), graph.get_node_by_id(dest)
+    return None, None
+
+
+def replan(graph: Graph, start, dest) -> float:
+    # Block the cell in front of the robot and plan again, as /move does
+    path = graph.build_path(start, dest)
+    if len(path) < 3:
+        return 0.0
+    step = path[2].cell - path[1].cell
+    direction = {-graph.wid: "N", graph.wid: "S", 1: "E", -1: "W"}[step]
+    begin = time.perf_counter()
+    graph.mark_as_obstacle(path[2], direction)
+    try:
+        graph.build_path(path[1], dest)
+    except KeyError:
+        pass
+    return time.perf_counter() - begin
+
+
+def bench_case(length: int, width: int, density: float, repeat: int, seed: int):
+    rng = random.Random(seed)
+    obstacles = make_obstacles(length, width, density, rng)
+    result = {"size": "%dx%d" % (length, width), "density": density}
+
+    result["init_s"] = timed(lambda: Graph(length, width, obstacles), repeat)
+    blocked = bytearray(length * width)
+    for cell in obstacles:
+        blocked[cell] = 1
+    result["from_blocked_s"] = timed(
+        lambda: Graph.from_blocked(length, width, blocked), repeat
+    )
+    tracemalloc.start()
+    graph = Graph(length, width, obstacles)
+    result["init_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start, dest = pick_route(graph, rng)
+    if start is None:
+        return result
+    result["build_path_s"] = timed(lambda: graph.build_path(start, dest), repeat)
+    costs = (MOVE_FWD_TIME, 3 * TURN_RGT_TIME, 3 * TURN_LFT_TIME)
+    result["build_timed_path_s"] = timed(
+        lambda: graph.build_path(start, dest, "N", costs), repeat
+    )
+    path = graph.build_path(start, dest)
+    result["path_length"] = len(path)
+    result["command_sequence_s"] = timed(
+        lambda: graph.create_command_sequence(path, "N"), repeat
+    )
+
+    tracemalloc.start()
+    graph.build_path(start, dest)
+    result["build_path_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    for name, incremental in [("replan_s", False), ("replan_incremental_s", True)]:
+        samples = []
+        for _ in range(repeat):
+            graph = Graph(length, width, obstacles, incremental=incremental)
+            samples.append(replan(graph, start, dest))
+        result[name] = statistics.median(samples)
+    return result
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    old = {(entry["size"], entry["density"]): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        previous = old.get((entry["size"], entry["density"]))
+        if previous is None:
+            continue
+        for key, value in entry.items():
+            if not key.endswith("_s") or not previous.get(key):
+                continue
+            if value > previous[key] * threshold:
+                regressions.append(
+                    "%s %s %s: %.6f -> %.6f"
+                    % (entry["size"], entry["density"], key, previous[key], value)
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark utils.pathing.Graph")
+    parser.add_argument("--sizes", nargs="+", default=SIZES)
+    parser.add_argument("--densities", nargs="+", type=float, default=DENSITIES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="earlier JSON report to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="fail when a timing is this many times slower than the baseline",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        length, width = (int(value) for value in size.split("x"))
+        for density in args.densities:
+            # Graph and mark_as_obstacle print their work
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                entry = bench_case(length, width, density, args.repeat, args.seed)
+            print(json.dumps(entry), file=sys.stderr)
+            results.append(entry)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+        for regression in regressions:
+            print("Regression: %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
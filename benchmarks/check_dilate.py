@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Run from the repository root: python -m benchmarks.check_dilate
+# Checks dilate against a brute-force disc on random grids, exits with
+# status 1 if they disagree.
+import argparse
+import random
+import sys
+
+from utils.pathing import dilate
+
+
+def check_dilate(rng: random.Random, length: int, width: int, radius: int):
+    blocked = bytes(rng.random() < 0.03 for _ in range(length * width))
+    expected = bytearray(b"\x01") * (length * width)
+    for cell, value in enumerate(blocked):
+        if not value:
+            continue
+        row, col = divmod(cell, width)
+        for other_row in range(max(0, row - radius), min(length, row + radius + 1)):
+            for other_col in range(max(0, col - radius), min(width, col + radius + 1)):
+                if (other_row - row) ** 2 + (other_col - col) ** 2 <= radius**2:
+                    expected[other_row * width + other_col] = 0
+    found = dilate(blocked, length, width, radius)
+    if found != expected:
+        cell = next(i for i, (a, b) in enumerate(zip(found, expected)) if a != b)
+        return "cell %d is %d, the disc says %d" % (cell, found[cell], expected[cell])
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check dilate against brute force")
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    for case in range(args.cases):
+        length, width = rng.randint(5, 30), rng.randint(5, 30)
+        radius = rng.randint(0, 4)
+        error = check_dilate(rng, length, width, radius)
+        if error:
+            failures += 1
+            print("case %d %dx%d radius %d: %s" % (case, length, width, radius, error))
+    print("%d cases, %d failures" % (args.cases, failures))
+    sys.exit(1 if failures else 0)
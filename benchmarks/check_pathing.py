@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Run from the repository root: python -m benchmarks.check_pathing
+# Checks the incremental planner against brute force on random maps, exits
+# with status 1 if they disagree. dilate is checked by check_dilate.
+import argparse
+import contextlib
+import os
+import random
+import signal
+import sys
+
+from utils.pathing import Graph, Node
+from utils.routecache import UNREACHABLE, search
+
+# A broken planner tends to loop forever rather than fail, in seconds
+CASE_TIMEOUT = 10
+
+
+class TimedOut(Exception):
+    pass
+
+
+def timed_out(signum, frame):
+    raise TimedOut()
+
+
+def check_path(graph: Graph, path: list, start: int, dest: int) -> str:
+    cells = [node.cell for node in path]
+    if cells[0] != start or cells[-1] != dest:
+        return "path runs %d..%d" % (cells[0], cells[-1])
+    for cell, next_cell in zip(cells[:-1], cells[1:]):
+        if next_cell not in graph.neighbours(cell):
+            return "step %d -> %d is not a free neighbour" % (cell, next_cell)
+    return None
+
+
+def check_dstar(rng: random.Random, length: int, width: int, density: float):
+    inner = [i * width + j for i in range(1, length - 1) for j in range(1, width - 1)]
+    obstacles = rng.sample(inner, int(len(inner) * density / 5))
+    graph = Graph(length, width, obstacles, incremental=True)
+    free = [cell for cell in range(len(graph.cells)) if graph.cells[cell]]
+    if len(free) < 2:
+        return None
+    start, dest = rng.sample(free, 2)
+    for _ in range(20):
+        # The robot gets a step further and finds a few more obstacles
+        distances = search(graph, start)[0]
+        try:
+            path = graph.build_path(Node(graph, start), Node(graph, dest))
+        except KeyError:
+            if distances[dest] != UNREACHABLE:
+                return "no path %d -> %d, BFS has %d" % (start, dest, distances[dest])
+            return None
+        if distances[dest] == UNREACHABLE:
+            return "path %d -> %d that BFS cannot find" % (start, dest)
+        if len(path) - 1 != distances[dest]:
+            return "path %d -> %d of %d steps, BFS has %d" % (
+                start,
+                dest,
+                len(path) - 1,
+                distances[dest],
+            )
+        error = check_path(graph, path, start, dest)
+        if error:
+            return error
+        if len(path) >= 2:
+            start = path[1].cell
+        if start == dest:
+            return None
+        candidates = [cell for cell in free if graph.cells[cell] and cell != start]
+        candidates.remove(dest)
+        graph.block(rng.sample(candidates, min(len(candidates), rng.randint(1, 4))))
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check D* Lite against brute force")
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGALRM, timed_out)
+    rng = random.Random(args.seed)
+    failures = 0
+    for case in range(args.cases):
+        length, width = rng.randint(5, 30), rng.randint(5, 30)
+        signal.alarm(CASE_TIMEOUT)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                error = check_dstar(rng, length, width, rng.random() * 0.3)
+        except TimedOut:
+            error = "no answer within %d s" % CASE_TIMEOUT
+        finally:
+            signal.alarm(0)
+        if error:
+            failures += 1
+            print("case %d %dx%d: %s" % (case, length, width, error))
+    print("%d cases, %d failures" % (args.cases, failures))
+    sys.exit(1 if failures else 0)
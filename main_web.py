@@ -1,140 +1,80 @@
 import json
-import serial
+import math
 import time
-import pickle
 import os
-import ast
 import itertools
 import random
-import RPi.GPIO as GPIO
-
-
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from utils.pathing import Graph
-from utils.ultrasonic import Rangefinder
-
-DEBUG_MODE = 1
-
-MOVEMENT_ITERATIONS = 5
-MINIMAL_DISTANCE = 15
-RANGEFINDER_DELTA = 1.5
-TURNING_DELTA = 0.01
-GPIO.setmode(GPIO.BCM)
-
-TRIGGER_PINS = [18, 17, 12, 16, 20]
-ECHO_PINS = [24, 27, 13, 19, 26]
-RANGE_NAMES = ["left_60", "left_30", "fwd", "rgt_30", "rgt_60"]
-
-
-class RobotState:
-    def __init__(self):
-        self.direction = "N"
-        self.position = None
-        self.move_time = 0.0
-        self.turn_time = 0.0
-
-    def change_dir_lft(self):
-        if self.direction == "N":
-            self.direction = "W"
-        elif self.direction == "W":
-            self.direction = "S"
-        elif self.direction == "S":
-            self.direction = "E"
-        elif self.direction == "E":
-            self.direction = "N"
-
-    def change_dir_rgt(self):
-        if self.direction == "N":
-            self.direction = "E"
-        elif self.direction == "E":
-            self.direction = "S"
-        elif self.direction == "S":
-            self.direction = "W"
-        elif self.direction == "W":
-            self.direction = "N"
-
-    def calibrate(self, conn, rangefinders):
-        start = rangefinders["fwd"].get_distance()
-        print(start)
-        self.prepare(conn)
-        # Moving forward
-        send_cmd(conn, b"FWD\n")
-        time.sleep(2)
-        send_cmd(conn, b"STP\n")
-        finish = rangefinders["fwd"].get_distance()
-        print(finish)
-        self.move_fwd_time = round(20.0 / abs(finish - start), 4)
-        print(self.move_fwd_time)
-        # Returning back
-        send_cmd(conn, b"BCK\n")
-        time.sleep(2)
-        send_cmd(conn, b"STP\n")
-        time.sleep(2)
-
-        start = rangefinders["fwd"].get_distance()
-        distance = 0.0
-        # Turning right
-        start_time = time.time()
-        send_cmd(conn, b"RGT\n")
-        time.sleep(1)
-        while distance > (start + RANGEFINDER_DELTA) or distance < (
-            start - RANGEFINDER_DELTA
-        ):
-            distance = rangefinders["fwd"].get_distance()
-            time.sleep(0.01)
-        stop_time = time.time()
-        # Divide the time of 360 turn by 12 to get 30 turn
-        self.turn_rgt_time = round((stop_time - start_time) / 12, 4)
-        send_cmd(conn, b"STP\n")
-
-        time.sleep(2)
-
-        start = rangefinders["fwd"].get_distance()
-        distance = 0.0
-        # Turning left
-        start_time = time.time()
-        send_cmd(conn, b"LFT\n")
-        time.sleep(1)
-        while distance > (start + RANGEFINDER_DELTA) or distance < (
-            start - RANGEFINDER_DELTA
-        ):
-            distance = rangefinders["fwd"].get_distance()
-            time.sleep(0.01)
-        stop_time = time.time()
-        # Divide the time of 360 turn by 12 to get 30 turn
-        self.turn_lft_time = round((stop_time - start_time) / 12, 4)
-        send_cmd(conn, b"STP\n")
-        return
-
-    def prepare(self, conn):
-        time.sleep(1)
-        send_cmd(conn, b"FWD\n")
-        time.sleep(0.1)
-        send_cmd(conn, b"BCK\n")
-        time.sleep(0.1)
-        send_cmd(conn, b"STP\n")
-
-    def print_state(self):
-        print(
-            {
-                "Direction": self.direction,
-                "Position": self.position,
-                "Move Forward Time": self.move_fwd_time,
-                "Turn Right Time": self.turn_rgt_time,
-                "Turn Left Time": self.turn_lft_time,
-            }
-        )
-
 
-def float_range(start, end, step):
-    while start <= end:
-        yield start
-        start += step
 
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.calibration import OnlineCalibrator
+from utils.executor import MotionExecutor
+from utils.fleet import FleetAgent
+from utils.hardware import open_robot, open_simulator
+from utils.maploader import load_map
+from utils.mapstore import MapStore
+from utils.metrics import REGISTRY
+from utils.occupancy import OccupancyGrid
+from utils.odometry import RangeOdometry
+from utils.routecache import RouteCache
+from utils.trace import TracedConnection, TracedSensors, TraceRecorder
+from utils.robot import (
+    CELL_SIZE,
+    MOVE_FWD_TIME,
+    TURN_LFT_TIME,
+    TURN_RGT_TIME,
+    RobotState,
+    send_cmd,
+)
 
-def send_cmd(conn, cmd: str):
-    conn.write(cmd)
-    return
+# "robot" drives the real hardware, "sim" a simulated robot in a random map
+BACKEND = os.environ.get("ROBOT_BACKEND", "robot")
+# "host:port" of a fleet coordinator shared with other robots, if any
+FLEET = os.environ.get("ROBOT_FLEET")
+ROBOT_ID = os.environ.get("ROBOT_ID", "0")
+# Seconds between two telemetry events on /events
+EVENT_PERIOD = 0.25
+# Needs firmware that speaks the framed "<seq> <CMD> [ms]" protocol
+SERIAL_ACKNOWLEDGED = False
+# Plan trips by calibrated drive and turn times instead of by cell count
+MIN_TIME_ROUTES = True
+# Repair routes with D* Lite when obstacles are marked. Only routes by cell
+# count are repaired, minimum time routes are planned again from scratch,
+# so this is only worth keeping when MIN_TIME_ROUTES is off.
+INCREMENTAL_ROUTES = not MIN_TIME_ROUTES
+# Map obstacles ahead from every rangefinder reading, not only when blocked
+OCCUPANCY_GRID = True
+# End forward moves on the range to known walls instead of on the timer.
+# Off until it arrives more often than the timer at CELL_SIZE with noisy
+# rangefinders, see python -m utils.simulator --closed-loop --noise 0.05
+CLOSED_LOOP = False
+# Refine the drive and turn times from every trip and keep them with the map.
+# Off while it still drifts from timings that are already right, see
+# python -m utils.simulator --online-calibration --min-time --noise 0.05
+ONLINE_CALIBRATION = False
+# Occupancy and calibration snapshot kept across restarts, one per robot
+MAP_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "map.bin" if ROBOT_ID == "0" else "map-%s.bin" % ROBOT_ID,
+)
+# Survey map (CSV, PGM, PNG or .npy) to start a new snapshot from, again
+# whenever the file changes, and the robot radius in cells its obstacles are
+# grown by
+SURVEY_MAP = os.environ.get("ROBOT_MAP")
+ROBOT_RADIUS = 1
+# Obstacles marked on the way and blocked by the occupancy grid are kept in
+# the snapshot for good. ROBOT_MAP_RESET=1 starts it again from the map above,
+# to clear the ones left by people or boxes that are gone since.
+RESET_MAP = os.environ.get("ROBOT_MAP_RESET") == "1"
+# Cell and heading the robot is put down at, the nearest free cell is used
+# when the map has this one blocked
+START_CELL = int(os.environ.get("ROBOT_START", "16"))
+START_DIRECTION = os.environ.get("ROBOT_HEADING", "S")
+# Stops of a tour when /tour is not given any
+TOUR_STOPS = 5
+# File to record the trips to for `python -m utils.trace replay`, if any
+TRACE_PATH = os.environ.get("ROBOT_TRACE")
 
 
 html = """<html>
@@ -155,10 +95,13 @@ html = """<html>
                         xmlHttp.send(params);
                     }
 
+                    var lastJob = null;
+
                     function Calibrate() {
                         document.getElementById("textstatus").textContent = "Calibrating...";
                         httpPostAsync("cal", JSON.stringify({}), function(resp) { 
                             document.getElementById("textstatus").textContent = `Calibrate: ${resp}`;
+                            try { lastJob = JSON.parse(resp).id; } catch (e) {}
                         });
                     }
 
@@ -166,146 +109,360 @@ html = """<html>
                         document.getElementById("textstatus").textContent = "Moving...";
                         httpPostAsync("move", JSON.stringify({}), function(resp) { 
                             document.getElementById("textstatus").textContent = `Movement: ${resp}`;
+                            try { lastJob = JSON.parse(resp).id; } catch (e) {}
+                        });
+                    }
+
+                    function TourRandom() {
+                        document.getElementById("textstatus").textContent = "Touring...";
+                        httpPostAsync("tour", JSON.stringify({}), function(resp) { 
+                            document.getElementById("textstatus").textContent = `Tour: ${resp}`;
+                            try { lastJob = JSON.parse(resp).id; } catch (e) {}
                         });
-                    }                            
+                    }
+
+                    function Stop() {
+                        httpPostAsync("stop", JSON.stringify({}), function(resp) { 
+                            document.getElementById("textstatus").textContent = `Stop: ${resp}`;
+                        });
+                    }
+
+                    var events = new EventSource("/events");
+                    events.onmessage = function(event) {
+                        var status = JSON.parse(event.data);
+                        var job = status.job ? `job ${status.job.id} ${status.job.status}, path ${status.job.path}` : "idle";
+                        document.getElementById("telemetry").textContent =
+                            `Position ${status.robot.position} ${status.robot.direction}, ${job}, sensors ${JSON.stringify(status.sensors)}`;
+                    };
+
+                    function Cancel() {
+                        httpPostAsync("cancel", JSON.stringify({job: lastJob}), function(resp) { 
+                            document.getElementById("textstatus").textContent = `Cancel: ${resp}`;
+                        });
+                    }
               </script>
               <body>
                  <h2>Hello from the Robot!</h2>
                  <p><button class="button button_led" onclick="Calibrate();">Calibrate</button></p>
                  <p><button class="button button_led" onclick="MoveRandom();">Random Move</button></p>
+                 <p><button class="button button_led" onclick="TourRandom();">Random Tour</button></p>
+                 <p><button class="button button_led" onclick="Cancel();">Cancel</button></p>
+                 <p><button class="button button_led" onclick="Stop();">Stop</button></p>
                  <span id="textstatus">Status: Waiting</span>
+                 <p><span id="telemetry"></span></p>
               </body>
             </html>"""
 
-conn = serial.Serial("/dev/ttyACM0", 9600, timeout=1)
-conn.flush()
-robot = RobotState()
-time.sleep(1)
-# Establishing connection
-
-rangefinders = {}
-for trigger, echo, name in zip(TRIGGER_PINS, ECHO_PINS, RANGE_NAMES):
-    rangefinders[name] = Rangefinder(trigger, echo)
-
-robot.move_fwd_time = 0.448
-robot.turn_rgt_time = 0.3293
-robot.turn_lft_time = 0.4621
-robot.direction = "S"
-
-obst = []
-graph = Graph(12, 15, obst)
-graph_nodes = list(
-    itertools.chain.from_iterable([[node for node in row] for row in graph.nodes])
-)
-robot.position = graph.get_node_by_id(16)
+class RobotApp:
+    # Owns the hardware, the map and the executor. Nothing is opened before
+    # start(), so the planner and the handlers can be imported by other tools
+    # without taking over the robot.
+    def __init__(
+        self,
+        backend: str = BACKEND,
+        map_path: str = MAP_PATH,
+        survey_map: str = SURVEY_MAP,
+        fleet_address: str = FLEET,
+        robot_id: str = ROBOT_ID,
+        trace_path: str = TRACE_PATH,
+        start_cell: int = START_CELL,
+        start_direction: str = START_DIRECTION,
+        reset_map: bool = RESET_MAP,
+    ):
+        self.backend = backend
+        self.map_path = map_path
+        self.survey_map = survey_map
+        self.reset_map = reset_map
+        self.fleet_address = fleet_address
+        self.robot_id = robot_id
+        self.trace_path = trace_path
+        self.start_cell = start_cell
+        self.start_direction = start_direction
+        self.hardware = None
+        self.store = None
+        self.graph = None
+        self.graph_nodes = []
+        self.robot = None
+        self.routes = None
+        self.fleet = None
+        self.occupancy = None
+        self.odometry = None
+        self.calibrator = None
+        self.trace = None
+        self.executor = None
+
+    def open_hardware(self):
+        if self.backend == "sim":
+            return open_simulator(
+                12, 15, start=self.start_cell, direction=self.start_direction
+            )
+        return open_robot(acknowledged=SERIAL_ACKNOWLEDGED)
+
+    def open_map(self):
+        store = MapStore(self.map_path)
+        if self.survey_map:
+            survey = load_map(self.survey_map, ROBOT_RADIUS)
+            graph = store.open(
+                survey.len,
+                survey.wid,
+                [],
+                incremental=INCREMENTAL_ROUTES,
+                base=survey,
+                reset=self.reset_map,
+            )
+        else:
+            graph = store.open(
+                12, 15, [], incremental=INCREMENTAL_ROUTES, reset=self.reset_map
+            )
+        return store, graph
+
+    def start(self):
+        started = time.perf_counter()
+        # The hardware mostly waits on the port and the pins, the map is
+        # loaded meanwhile
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            hardware = pool.submit(self.open_hardware)
+            try:
+                self.store, self.graph = self.open_map()
+            except Exception:
+                # Kept so that stop() closes it, without a hardware error
+                # hiding why the map failed
+                if hardware.exception() is None:
+                    self.hardware = hardware.result()
+                raise
+            self.hardware = hardware.result()
+        graph = self.graph
+
+        robot = RobotState()
+        robot.clock = self.hardware.clock
+        robot.move_fwd_time = MOVE_FWD_TIME
+        robot.turn_rgt_time = TURN_RGT_TIME
+        robot.turn_lft_time = TURN_LFT_TIME
+        robot.direction = self.start_direction
+        self.store.load_calibration(robot)
+        robot.position = graph.nearest_free(self.start_cell)
+        if robot.position is None:
+            raise ValueError("The map has no free cell to start from")
+        if robot.position.cell != self.start_cell:
+            print(
+                "Start cell %d is blocked, starting from %d"
+                % (self.start_cell, robot.position.cell)
+            )
+            if self.hardware.place:
+                self.hardware.place(robot.position.cell, robot.direction)
+        self.robot = robot
+        self.graph_nodes = list(
+            itertools.chain.from_iterable(
+                [[node for node in row] for row in graph.nodes]
+            )
+        )
+
+        # Robots are sent between the same few cells, repeat routes come from here
+        self.routes = RouteCache(graph)
+        if self.fleet_address:
+            fleet_host, fleet_port = self.fleet_address.rsplit(":", 1)
+            self.fleet = FleetAgent(
+                self.robot_id, graph, (fleet_host, int(fleet_port))
+            )
+            self.fleet.park(robot.position.cell)
+        if OCCUPANCY_GRID:
+            self.occupancy = OccupancyGrid(graph, CELL_SIZE, radius=ROBOT_RADIUS)
+        if CLOSED_LOOP:
+            self.odometry = RangeOdometry(graph, CELL_SIZE)
+        if ONLINE_CALIBRATION:
+            self.calibrator = OnlineCalibrator(
+                robot, self.store.save_calibration, cell_size=CELL_SIZE
+            )
+
+        conn = self.hardware.conn
+        sensors = self.hardware.sensors
+        if self.trace_path:
+            # Only what the executor sees is recorded, not the status polls
+            self.trace = TraceRecorder(self.trace_path, self.hardware.clock)
+            self.trace.config(
+                min_time=MIN_TIME_ROUTES,
+                routes=True,
+                occupancy=OCCUPANCY_GRID,
+                closed_loop=CLOSED_LOOP,
+                online_calibration=ONLINE_CALIBRATION,
+                cell_size=CELL_SIZE,
+                radius=ROBOT_RADIUS,
+                incremental=INCREMENTAL_ROUTES,
+                acknowledged=SERIAL_ACKNOWLEDGED,
+                fleet=bool(self.fleet),
+            )
+            self.trace.snapshot(graph)
+            graph.listeners.append(self.trace.on_change)
+            conn = TracedConnection(conn, self.trace)
+            sensors = TracedSensors(sensors, self.trace)
+
+        self.executor = MotionExecutor(
+            conn,
+            robot,
+            graph,
+            sensors,
+            clock=self.hardware.clock,
+            on_calibrated=self.store.save_calibration,
+            min_time=MIN_TIME_ROUTES,
+            routes=self.routes,
+            fleet=self.fleet,
+            occupancy=self.occupancy,
+            odometry=self.odometry,
+            calibrator=self.calibrator,
+            trace=self.trace,
+        )
+        self.executor.start()
+        print("Started in %.3f s" % (time.perf_counter() - started))
+
+    def stop(self):
+        # Safe to call after a failed start, closes whatever was opened
+        if self.executor:
+            self.executor.stop()
+            self.executor = None
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+        if self.fleet:
+            self.fleet.close()
+            self.fleet = None
+        if self.hardware:
+            self.hardware.close()
+            self.hardware = None
+        if self.store:
+            self.store.close()
+            self.store = None
+
+    def get_status(self) -> dict:
+        job = self.executor.current
+        sample = self.hardware.sensors.latest
+        readings = {}
+        if sample:
+            # Infinity is not valid JSON, report a missing echo as null
+            readings = {
+                name: round(distance, 1) if math.isfinite(distance) else None
+                for name, distance in sample[1].items()
+            }
+        return {
+            "robot": self.robot.to_dict(),
+            "job": job.to_dict() if job else None,
+            "sensors": readings,
+        }
 
 
 class ServerHandler(BaseHTTPRequestHandler):
+    def send_json(self, data: dict, code: int = 200):
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode("utf-8"))
+
+    def send_events(self):
+        # Server-Sent Events, one status snapshot per EVENT_PERIOD
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                event = "data: %s\n\n" % json.dumps(self.server.app.get_status())
+                self.wfile.write(event.encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(EVENT_PERIOD)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
     def do_GET(self):
         print("GET request, path:", self.path)
+        app = self.server.app
         if self.path == "/":
             self.send_response(200)
             self.send_header("Content-type", "text/html")
             self.end_headers()
             self.wfile.write(html.encode("utf-8"))
+        elif self.path == "/status":
+            self.send_json(app.get_status())
+        elif self.path == "/events":
+            self.send_events()
+        elif self.path == "/metrics":
+            # Prometheus text exposition format
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.end_headers()
+            self.wfile.write(REGISTRY.render().encode("utf-8"))
+        elif self.path.startswith("/job/"):
+            job_id = self.path[len("/job/") :]
+            job = app.executor.jobs.get(int(job_id)) if job_id.isdecimal() else None
+            if job is None:
+                self.send_error(404, "Job Not Found {}".format(self.path))
+            else:
+                self.send_json(job.to_dict())
         else:
             self.send_error(404, "Page Not Found {}".format(self.path))
 
     def do_POST(self):
         content_length = int(self.headers["Content-Length"])
         body = self.rfile.read(content_length)
+        app = self.server.app
+        executor = app.executor
         try:
             print("POST request, path:", self.path, "body:", body.decode("utf-8"))
             if self.path == "/cal":
                 print("Recieved Calibrate")
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                robot.calibrate(conn, rangefinders)
-                self.wfile.write(b"Finished")
+                job = executor.submit("cal")
+                self.send_json(job.to_dict())
             elif self.path == "/move":
                 print("Recieved Move Command")
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                destination = random.choice(graph_nodes)
+                destination = random.choice(app.graph_nodes)
                 while destination.id == -1:
-                    destination = random.choice(graph_nodes)
-                path = graph.build_path(robot.position, destination)
-                cmd_list = graph.create_command_sequence(path, initial_direction="S")
-                robot_is_at_finish = False
-                robot.prepare(conn)
-                while not robot_is_at_finish:
-                    print("Starting new route")
-                    for cmd in cmd_list:
-                        if cmd == "fwd":
-                            if (
-                                rangefinders["fwd"].get_distance() <= MINIMAL_DISTANCE
-                                or rangefinders["left_30"].get_distance()
-                                <= MINIMAL_DISTANCE
-                                or rangefinders["rgt_30"].get_distance()
-                                <= MINIMAL_DISTANCE
-                            ) and path[1] in graph_nodes:
-                                send_cmd(conn, b"STP\n")
-                                print(graph.mark_as_obstacle(path[1], robot.direction))
-                                path = graph.build_path(robot.position, destination)
-                                cmd_list = graph.create_command_sequence(
-                                    path, robot.direction
-                                )
-                                print("Found obstacle")
-                                break
-                            send_cmd(conn, b"FWD\n")
-                            for i in float_range(
-                                0,
-                                robot.move_fwd_time,
-                                robot.move_fwd_time / MOVEMENT_ITERATIONS,
-                            ):
-                                if (
-                                    rangefinders["left_60"].get_distance()
-                                    <= MINIMAL_DISTANCE / 2
-                                ):
-                                    send_cmd(conn, b"RGT\n")
-                                    time.sleep(robot.turn_rgt_time / 2)
-                                    send_cmd(conn, b"FWD\n")
-                                if (
-                                    rangefinders["rgt_60"].get_distance()
-                                    <= MINIMAL_DISTANCE / 2
-                                ):
-                                    send_cmd(conn, b"LFT\n")
-                                    time.sleep(robot.turn_lft_time / 2)
-                                    send_cmd(conn, b"FWD\n")
-                                time.sleep(robot.move_fwd_time / MOVEMENT_ITERATIONS)
-                            path.remove(robot.position)
-                            robot.position = path[0]
-                            send_cmd(conn, b"STP\n")
-                        elif cmd == "rgt":
-                            send_cmd(conn, b"RGT\n")
-                            time.sleep(3 * robot.turn_rgt_time)
-                            robot.change_dir_rgt()
-                            send_cmd(conn, b"STP\n")
-                        elif cmd == "lft":
-                            send_cmd(conn, b"LFT\n")
-                            time.sleep(3 * robot.turn_lft_time)
-                            robot.change_dir_lft()
-                            send_cmd(conn, b"STP\n")
-
-                        print([node.id for node in path], len(path))
-                    send_cmd(conn, b"STP\n")
-                    if len(path) < 2:
-                        robot_is_at_finish = True
-                self.wfile.write(b"Finished")
-
+                    destination = random.choice(app.graph_nodes)
+                job = executor.submit("move", destination)
+                self.send_json(job.to_dict())
+            elif self.path == "/tour":
+                print("Recieved Tour Command")
+                # {"stops": [cell, ...]}, random free cells when left out
+                cells = json.loads(body or b"{}").get("stops")
+                if cells is None:
+                    free = [node for node in app.graph_nodes if node.id != -1]
+                    stops = random.sample(free, min(TOUR_STOPS, len(free)))
+                else:
+                    stops = [app.graph.get_node_by_id(cell) for cell in cells]
+                if not stops or None in stops:
+                    self.send_json({"error": "stops must be free cells"}, 400)
+                else:
+                    job = executor.submit("tour", stops[-1], stops)
+                    self.send_json(job.to_dict())
+            elif self.path == "/cancel":
+                print("Recieved Cancel Command")
+                job_id = json.loads(body)["job"]
+                self.send_json({"job": job_id, "cancelled": executor.cancel(job_id)})
+            elif self.path == "/stop":
+                print("Recieved Stop Command")
+                cancelled = executor.cancel_all()
+                send_cmd(app.hardware.conn, b"STP\n")
+                self.send_json({"cancelled": cancelled})
             else:
                 self.send_response(400, "Bad Request: Method does not exist")
                 self.send_header("Content-Type", "application/json")
                 self.end_headers()
+        except (ValueError, KeyError, TypeError) as err:
+            # Malformed JSON or a missing or mistyped field, nothing was
+            # sent yet
+            print("do_POST bad request: %r" % err)
+            self.send_json({"error": "bad request body: %r" % err}, 400)
         except Exception as err:
             print("do_POST exception: %s" % str(err))
 
 
-def server_thread(port):
-    server_address = ("", port)
-    httpd = HTTPServer(server_address, ServerHandler)
+class RobotServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, app: RobotApp, address=("", 8000)):
+        super().__init__(address, ServerHandler)
+        self.app = app
+
+
+def server_thread(app: RobotApp, port: int):
+    httpd = RobotServer(app, ("", port))
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -316,7 +473,11 @@ def server_thread(port):
 if __name__ == "__main__":
 
     port = 8000
-    print("Starting server at port %d" % port)
+    app = RobotApp()
 
-    server_thread(port)
-    GPIO.cleanup()
+    try:
+        app.start()
+        print("Starting server at port %d" % port)
+        server_thread(app, port)
+    finally:
+        app.stop()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+from utils.robot import CELL_SIZE
+
+# Weight of a new sample in the running estimates
+ALPHA = 0.1
+# Samples this far from the estimate, relative to it, are dropped
+OUTLIER = 0.5
+# Shortest run in cm and smallest turn in degrees worth a sample
+MIN_TRAVEL = 5.0
+MIN_TURN = 45.0
+
+
+class OnlineCalibrator:
+    # Refines move_fwd_time, turn_rgt_time and turn_lft_time from normal
+    # trips with exponentially weighted averages, so the robot does not
+    # have to be taken out of service for RobotState.calibrate. The
+    # executor reports how long a command ran and how far the rangefinders
+    # say it got; the new values are handed to on_update after each trip.
+    def __init__(
+        self,
+        robot,
+        on_update=None,
+        alpha: float = ALPHA,
+        cell_size: float = CELL_SIZE,
+    ):
+        self.robot = robot
+        self.on_update = on_update
+        self.alpha = alpha
+        self.cell_size = cell_size
+        self.samples = {"move_fwd_time": 0, "turn_rgt_time": 0, "turn_lft_time": 0}
+        self.changed = False
+
+    def update(self, name: str, sample: float) -> bool:
+        current = getattr(self.robot, name)
+        if sample <= 0 or current and abs(sample - current) > OUTLIER * current:
+            return False
+        if current:
+            # The first samples weigh more, the stored value is only a guess
+            alpha = max(self.alpha, 1 / (self.samples[name] + 2))
+            sample = current + alpha * (sample - current)
+        setattr(self.robot, name, sample)
+        self.samples[name] += 1
+        self.changed = True
+        return True
+
+    def observe_move(self, seconds: float, travelled: float) -> bool:
+        # seconds of driving forward that covered travelled cm
+        if not travelled >= MIN_TRAVEL:
+            return False
+        return self.update("move_fwd_time", seconds * self.cell_size / travelled)
+
+    def observe_turn(self, cmd: bytes, seconds: float, degrees: float) -> bool:
+        if not degrees >= MIN_TURN:
+            return False
+        name = "turn_rgt_time" if cmd == b"RGT" else "turn_lft_time"
+        # One turn_*_time turns the robot by 30 degrees
+        return self.update(name, seconds * 30 / degrees)
+
+    def commit(self):
+        if self.changed and self.on_update:
+            self.on_update(self.robot)
+        self.changed = False
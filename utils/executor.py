@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+import itertools
+import queue
+import threading
+import time
+
+from utils.metrics import histogram
+from utils.odometry import (
+    CONFIRM,
+    HEADING_TOLERANCE,
+    STEPS_PER_CELL,
+    TIMEOUT,
+    RangeOdometry,
+)
+from utils.pathing import Node
+from utils.robot import MINIMAL_DISTANCE, MOVEMENT_ITERATIONS, send_cmd
+from utils.tour import order_stops
+
+# How often a waiting job looks at its cancel flag
+TICK = 0.02
+# Finished, failed and cancelled jobs kept for /job, oldest dropped first
+JOB_HISTORY = 100
+
+
+class Cancelled(Exception):
+    pass
+
+
+def command_timer(cmd: str):
+    return histogram(
+        "command_seconds", "Time of one executed trip command", cmd=cmd
+    ).time()
+
+
+class Job:
+    def __init__(self, id: int, kind: str, destination=None, stops=None):
+        self.id = id
+        self.kind = kind
+        self.destination = destination
+        # Nodes a tour visits, in the order driven once the tour has started
+        self.stops = stops or []
+        # Stops of a tour given up on as out of reach
+        self.skipped = []
+        self.status = "queued"
+        self.path = []
+        self.replans = 0
+        self.cancelled = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "destination": self.destination.id if self.destination else None,
+            "stops": [node.id for node in self.stops],
+            "skipped": [node.cell for node in self.skipped],
+            "path": [node.id for node in self.path],
+            "replans": self.replans,
+        }
+
+
+class MotionExecutor(threading.Thread):
+    # Runs queued trips and calibrations one at a time in its own thread,
+    # so the HTTP handler only has to submit a job and return its id
+    def __init__(
+        self,
+        conn,
+        robot,
+        graph,
+        sensors,
+        clock=time,
+        tick: float = TICK,
+        on_calibrated=None,
+        min_time: bool = False,
+        routes=None,
+        fleet=None,
+        occupancy=None,
+        odometry=None,
+        calibrator=None,
+        trace=None,
+    ):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.robot = robot
+        self.graph = graph
+        self.sensors = sensors
+        self.clock = clock
+        self.tick = tick
+        self.on_calibrated = on_calibrated
+        # Plan the quickest route for the calibrated timings instead of
+        # the one with the fewest cells
+        self.min_time = min_time
+        # Optional RouteCache in front of graph.build_path
+        self.routes = routes
+        # Optional FleetAgent, routes then come from the fleet coordinator
+        self.fleet = fleet
+        # Optional OccupancyGrid fed with every rangefinder at each cell
+        self.occupancy = occupancy
+        # Optional RangeOdometry, runs toward known walls then end on range
+        # instead of on the timer
+        self.odometry = odometry
+        # Optional OnlineCalibrator refined from the ranges seen on trips.
+        # Turns are measured on the known walls with or without odometry.
+        self.calibrator = calibrator
+        self.headings = odometry
+        if calibrator is not None and odometry is None:
+            self.headings = RangeOdometry(graph, calibrator.cell_size)
+        # Optional TraceRecorder logging jobs and planned paths
+        self.trace = trace
+        self.nudges = 0
+        # Whether the heading was measured on a wall since the robot last
+        # turned, so that a turn can be measured from one wall after it
+        self.aligned = False
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.current = None
+        self.ids = itertools.count(1)
+
+    def submit(self, kind: str, destination=None, stops=None) -> Job:
+        job = Job(next(self.ids), kind, destination, stops)
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        self.prune()
+        return job
+
+    def prune(self):
+        # Jobs are kept in submission order, queued and running ones stay
+        done = [
+            job_id
+            for job_id, job in list(self.jobs.items())
+            if job.status not in ["queued", "running"]
+        ]
+        for job_id in done[: max(0, len(self.jobs) - JOB_HISTORY)]:
+            self.jobs.pop(job_id, None)
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in ["queued", "running"]:
+            return False
+        job.cancelled.set()
+        return True
+
+    def cancel_all(self) -> list[int]:
+        return [job_id for job_id in list(self.jobs) if self.cancel(job_id)]
+
+    def stop(self):
+        self.cancel_all()
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.execute(job)
+
+    def execute(self, job: Job):
+        if job.cancelled.is_set():
+            job.status = "cancelled"
+            return
+        self.current = job
+        job.status = "running"
+        try:
+            if self.trace is not None:
+                self.trace.job(job, self.robot)
+            if job.kind == "cal":
+                self.robot.calibrate(
+                    self.conn,
+                    self.sensors.rangefinders,
+                    lambda duration: self.wait(job, duration),
+                )
+                if self.on_calibrated:
+                    self.on_calibrated(self.robot)
+            else:
+                self.move(job)
+            job.status = "finished"
+        except Cancelled:
+            job.status = "cancelled"
+        except Exception as err:
+            print("Job %d failed: %s" % (job.id, err))
+            job.status = "failed"
+        finally:
+            send_cmd(self.conn, b"STP\n")
+            if self.calibrator is not None:
+                self.calibrator.commit()
+            if self.trace is not None:
+                self.trace.status(job)
+            self.current = None
+
+    def wait(self, job: Job, duration: float):
+        deadline = self.clock.monotonic() + duration
+        while True:
+            if job.cancelled.is_set():
+                raise Cancelled()
+            remaining = deadline - self.clock.monotonic()
+            if remaining <= 0:
+                return
+            self.clock.sleep(min(self.tick, remaining))
+
+    def drive(self, job: Job, cmd: bytes, duration: float):
+        if getattr(self.conn, "acknowledged", False):
+            # The framed protocol times the command on the firmware side
+            self.conn.send(cmd, duration)
+            self.wait(job, duration)
+            return
+        send_cmd(self.conn, cmd + b"\n")
+        self.wait(job, duration)
+        send_cmd(self.conn, b"STP\n")
+
+    def forward(self, job: Job, cells: int = 1) -> bool:
+        # Drives a straight run of cells without stopping between them. The
+        # way ahead is checked at every cell boundary; False when an
+        # obstacle stopped the robot before the run was over.
+        robot = self.robot
+        path = job.path
+        moving = False
+        # (time, readings) taken on the move, and the side corrections
+        # before them, for the calibrator
+        samples = []
+        nudges = self.nudges
+        if self.odometry is not None:
+            self.align(job)
+        for _ in range(cells):
+            if self.occupancy is None:
+                distances = self.sensors.get_distances(["fwd", "left_30", "rgt_30"])
+            else:
+                distances = self.sensors.get_distances()
+                self.occupancy.update(robot.position.cell, robot.direction, distances)
+                # Route around what the map now knows before driving into it
+                if any(not self.graph.cells[node.cell] for node in path[1:]):
+                    send_cmd(self.conn, b"STP\n")
+                    print("Map changed ahead")
+                    return False
+            front = [distances[name] for name in ["fwd", "left_30", "rgt_30"]]
+            if min(front) <= MINIMAL_DISTANCE:
+                send_cmd(self.conn, b"STP\n")
+                print(self.graph.mark_as_obstacle(path[1], robot.direction))
+                print("Found obstacle")
+                return False
+            if moving:
+                samples.append(self.sensors.latest)
+            target = None
+            if self.odometry is not None and self.odometry.sees_wall(
+                robot.position.cell, robot.direction, distances["fwd"]
+            ):
+                target = self.odometry.expected(path[1].cell, robot.direction)
+            with command_timer("fwd"):
+                if not moving:
+                    send_cmd(self.conn, b"FWD\n")
+                    moving = True
+                if target is not None:
+                    self.drive_to(job, target)
+                else:
+                    # Check the side sensors at fixed points of the step.
+                    # Drift is not absorbed by a stop any more, so every
+                    # cell takes exactly move_fwd_time.
+                    for _ in range(MOVEMENT_ITERATIONS):
+                        self.keep_clear(job)
+                        self.wait(job, robot.move_fwd_time / MOVEMENT_ITERATIONS)
+            path.remove(robot.position)
+            robot.position = path[0]
+        samples.append(self.sensors.latest)
+        send_cmd(self.conn, b"STP\n")
+        samples = [sample for sample in samples if sample is not None]
+        # A run with side corrections was not straight, its range says
+        # little about the distance driven
+        if self.calibrator is not None and len(samples) >= 2 and self.nudges == nudges:
+            (start, first), (end, last) = samples[0], samples[-1]
+            self.calibrator.observe_move(end - start, first["fwd"] - last["fwd"])
+        return True
+
+    def keep_clear(self, job: Job):
+        robot = self.robot
+        distances = self.sensors.get_distances(["left_60", "rgt_60"])
+        if distances["left_60"] <= MINIMAL_DISTANCE / 2:
+            self.nudges += 1
+            self.aligned = False
+            send_cmd(self.conn, b"RGT\n")
+            self.wait(job, robot.turn_rgt_time / 2)
+            send_cmd(self.conn, b"FWD\n")
+        if distances["rgt_60"] <= MINIMAL_DISTANCE / 2:
+            self.nudges += 1
+            self.aligned = False
+            send_cmd(self.conn, b"LFT\n")
+            self.wait(job, robot.turn_lft_time / 2)
+            send_cmd(self.conn, b"FWD\n")
+
+    def drive_to(self, job: Job, target: float):
+        # Keeps driving until the wall ahead is target cm away, or until
+        # the timer runs out when the range never gets there. One short
+        # echo does not end the cell, CONFIRM readings in a row have to be
+        # in range. The robot drives on while they come in, so the range
+        # they are checked against is moved ahead by that much.
+        robot = self.robot
+        deadline = self.clock.monotonic() + TIMEOUT * robot.move_fwd_time
+        checks = STEPS_PER_CELL // MOVEMENT_ITERATIONS
+        target += (CONFIRM - 1) * self.odometry.cell_size / STEPS_PER_CELL
+        confirmed = 0
+        for step in itertools.count():
+            if self.sensors.get_distances(["fwd"])["fwd"] <= target:
+                confirmed += 1
+                if confirmed >= CONFIRM:
+                    return
+            else:
+                confirmed = 0
+            if self.clock.monotonic() >= deadline:
+                return
+            if step % checks == 0:
+                self.keep_clear(job)
+            self.wait(job, robot.move_fwd_time / STEPS_PER_CELL)
+
+    def heading_error(self) -> float:
+        robot = self.robot
+        distances = self.sensors.get_distances(["left_30", "fwd", "rgt_30"])
+        return self.odometry.heading_error(
+            robot.position.cell, robot.direction, distances
+        )
+
+    def scan_heading_error(self) -> float:
+        robot = self.robot
+        return self.headings.scan_heading_error(
+            robot.position.cell, robot.direction, self.sensors.get_distances()
+        )
+
+    def align(self, job: Job):
+        # Turns back onto the heading measured on a flat known wall ahead
+        robot = self.robot
+        error = self.heading_error()
+        self.aligned = error is not None
+        if error is None or abs(error) < HEADING_TOLERANCE:
+            return
+        print("Correcting heading by %.1f degrees" % -error)
+        # One turn_*_time turns the robot by about 30 degrees
+        if error > 0:
+            self.drive(job, b"LFT", error / 30 * robot.turn_lft_time)
+        else:
+            self.drive(job, b"RGT", -error / 30 * robot.turn_rgt_time)
+
+    def turn(self, job: Job, angle: int):
+        robot = self.robot
+        quarters = abs(angle) // 90
+        # The calibrator needs the heading before and after the turn
+        before = None
+        if self.calibrator is not None:
+            before = self.scan_heading_error()
+            if before is None and self.aligned:
+                before = 0.0
+        self.aligned = False
+        if angle > 0:
+            cmd, duration = b"RGT", 3 * quarters * robot.turn_rgt_time
+        else:
+            cmd, duration = b"LFT", 3 * quarters * robot.turn_lft_time
+        with command_timer("turn%+d" % angle):
+            self.drive(job, cmd, duration)
+        for _ in range(quarters):
+            if angle > 0:
+                robot.change_dir_rgt()
+            else:
+                robot.change_dir_lft()
+        if before is not None:
+            after = self.scan_heading_error()
+            if after is not None:
+                self.calibrator.observe_turn(cmd, duration, abs(angle + after - before))
+
+    def costs(self) -> tuple:
+        costs = self.robot.step_costs()
+        if not self.min_time or not all(costs):
+            # Turn times are unknown before the first calibration
+            return None
+        return costs
+
+    def plan(self, destination, start=None, direction=None):
+        robot = self.robot
+        start = robot.position if start is None else start
+        direction = robot.direction if direction is None else direction
+        planner = self.graph if self.routes is None else self.routes
+        path = planner.build_path(start, destination, direction, self.costs())
+        if self.trace is not None:
+            self.trace.path([node.cell for node in path])
+        return path
+
+    def plan_tour(self, job: Job, stops: list) -> tuple[list, list[int], list]:
+        # One path through every stop in turn, so that runs and turns carry
+        # on across stops, the index in it where each stop is reached and
+        # the stops kept. A tour skips the stops it cannot reach for good,
+        # the graph only gains obstacles; a single move fails.
+        path = [self.robot.position]
+        direction = self.robot.direction
+        ends = []
+        kept = []
+        for stop in stops:
+            try:
+                leg = self.plan(stop, path[-1], direction)
+            except KeyError:
+                if job.kind != "tour":
+                    raise
+                self.skip(job, stop)
+                continue
+            if len(leg) >= 2:
+                direction = self.heading(leg[-2], leg[-1])
+            path.extend(leg[1:])
+            ends.append(len(path) - 1)
+            kept.append(stop)
+        return path, ends, kept
+
+    def skip(self, job: Job, stop):
+        print("Skipping unreachable stop %d" % stop.cell)
+        job.skipped.append(stop)
+
+    def heading(self, node, next_node) -> str:
+        step = next_node.cell - node.cell
+        return {-self.graph.wid: "N", 1: "E", self.graph.wid: "S", -1: "W"}[step]
+
+    def move(self, job: Job):
+        if job.kind == "tour":
+            job.stops = [
+                Node(self.graph, cell)
+                for cell in order_stops(
+                    self.graph,
+                    self.robot.position.cell,
+                    [node.cell for node in job.stops],
+                    self.robot.direction,
+                    self.costs(),
+                )
+            ]
+            print("Tour order %s" % [node.id for node in job.stops])
+            if job.stops:
+                job.destination = job.stops[-1]
+        stops = job.stops or [job.destination]
+        if self.fleet is not None:
+            self.robot.prepare(self.conn, lambda duration: self.wait(job, duration))
+            for stop in stops:
+                try:
+                    self.move_in_fleet(job, stop)
+                except KeyError:
+                    if job.kind != "tour":
+                        raise
+                    self.skip(job, stop)
+            if len(job.skipped) == len(stops):
+                raise ValueError("No stop of the tour can be reached")
+            return
+        robot = self.robot
+        graph = self.graph
+        job.path, ends, stops = self.plan_tour(job, stops)
+        if not stops:
+            raise ValueError("No stop of the tour can be reached")
+        robot.prepare(self.conn, lambda duration: self.wait(job, duration))
+        while len(job.path) >= 2:
+            print("Starting new route")
+            length = len(job.path)
+            for kind, amount in graph.create_motion_plan(job.path, robot.direction):
+                if job.cancelled.is_set():
+                    raise Cancelled()
+                if kind == "turn":
+                    self.turn(job, amount)
+                elif not self.forward(job, amount):
+                    # Stops already driven through are not visited again
+                    driven = length - len(job.path)
+                    stops = stops[sum(end <= driven for end in ends) :]
+                    job.path, ends, stops = self.plan_tour(job, stops)
+                    job.replans += 1
+                    break
+                print([node.id for node in job.path], len(job.path))
+            send_cmd(self.conn, b"STP\n")
+
+    def move_in_fleet(self, job: Job, destination):
+        # Runs the coordinator's timed segments, every segment waits for
+        # the step reserved for it
+        robot = self.robot
+        try:
+            while robot.position != destination:
+                print("Starting new fleet route")
+                plan, cells, wait, step_seconds = self.fleet.plan(
+                    robot.position.cell,
+                    robot.direction,
+                    destination.cell,
+                    robot.step_costs(),
+                )
+                begin = self.clock.monotonic() + wait
+                job.path = [Node(self.graph, cell) for cell in cells]
+                if self.trace is not None:
+                    self.trace.path(cells)
+                for step, kind, amount in plan:
+                    start_at = begin + step * step_seconds
+                    self.wait(job, start_at - self.clock.monotonic())
+                    if kind == "turn":
+                        self.turn(job, amount)
+                    elif not self.forward(job, amount):
+                        job.replans += 1
+                        break
+                send_cmd(self.conn, b"STP\n")
+        finally:
+            self.fleet.park(robot.position.cell)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import math
+
+from collections import deque
+
+MEDIAN_WINDOW = 5
+# Readings further than this from the running median are treated as noise (cm)
+OUTLIER_DISTANCE = 20.0
+# Variances of the 1-D Kalman filter, in cm^2
+PROCESS_NOISE = 1.0
+MEASUREMENT_NOISE = 4.0
+
+
+class MedianFilter:
+    def __init__(self, window: int = MEDIAN_WINDOW, outlier: float = OUTLIER_DISTANCE):
+        self.window = deque(maxlen=window)
+        self.outlier = outlier
+        self.rejected = 0
+
+    def median(self) -> float:
+        return sorted(self.window)[len(self.window) // 2]
+
+    def update(self, value: float) -> float:
+        if self.window and abs(value - self.median()) > self.outlier:
+            self.rejected += 1
+            if self.rejected <= self.window.maxlen // 2:
+                return self.median()
+            # The jump persisted, so the scene changed and this is not noise
+            self.window.clear()
+        self.rejected = 0
+        self.window.append(value)
+        return self.median()
+
+
+class KalmanFilter:
+    def __init__(
+        self,
+        process_noise: float = PROCESS_NOISE,
+        measurement_noise: float = MEASUREMENT_NOISE,
+    ):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.estimate = None
+        self.error = 0.0
+
+    def update(self, value: float) -> float:
+        if not math.isfinite(value):
+            # Nothing in range, start over on the next echo
+            self.estimate = None
+            return value
+        if self.estimate is None:
+            self.estimate = value
+            self.error = self.measurement_noise
+            return value
+        self.error += self.process_noise
+        gain = self.error / (self.error + self.measurement_noise)
+        self.estimate += gain * (value - self.estimate)
+        self.error *= 1 - gain
+        return self.estimate
+
+
+class RangeFilter:
+    def __init__(
+        self,
+        window: int = MEDIAN_WINDOW,
+        outlier: float = OUTLIER_DISTANCE,
+        kalman: bool = False,
+    ):
+        self.median = MedianFilter(window, outlier)
+        self.kalman = KalmanFilter() if kalman else None
+
+    def update(self, value: float) -> float:
+        value = self.median.update(value)
+        if self.kalman:
+            value = self.kalman.update(value)
+        return value
+
+
+class FilteredRangefinder:
+    # Wraps a single Rangefinder, every ping goes through the filter
+    def __init__(self, rangefinder, filter: RangeFilter = None):
+        self.rangefinder = rangefinder
+        self.filter = filter or RangeFilter()
+
+    def get_distance(self) -> float:
+        return self.filter.update(self.rangefinder.get_distance())
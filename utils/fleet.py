@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import socket
+import socketserver
+import threading
+import time
+
+from heapq import heappop, heappush
+from utils.pathing import HEADINGS, Graph
+from utils.routecache import UNREACHABLE, search
+
+FLEET_PORT = 8600
+# Length of one step of the reservation table. Every command lasts a whole
+# number of steps, rounded up from the calibrated times of the robot.
+STEP_SECONDS = 0.25
+# Longest route in steps, waits included
+HORIZON = 512
+# Turns by the quarter turns they add to the heading
+TURNS = [(1, 90), (3, -90), (2, 180)]
+
+
+class Coordinator:
+    # Owns the map shared by the fleet and plans every robot around the
+    # others with cooperative A*: routes are searched over (cell, heading,
+    # step) and each planned route reserves its cells for the steps it
+    # spends in them, so robots planned later wait or detour instead of
+    # colliding.
+    def __init__(
+        self,
+        graph: Graph,
+        step_seconds: float = STEP_SECONDS,
+        horizon: int = HORIZON,
+        clock=time,
+    ):
+        self.graph = graph
+        self.step_seconds = step_seconds
+        self.horizon = horizon
+        self.clock = clock
+        self.epoch = clock.monotonic()
+        self.lock = threading.Lock()
+        # cell -> {step: robot}
+        self.slots = {}
+        # robot -> reserved (cell, step) pairs
+        self.routes = {}
+        # cell -> (robot, first step), a robot waiting there for good
+        self.parked = {}
+        # Cells blocked by reports, in order. A robot that has seen the
+        # first n of them is at version n.
+        self.changes = []
+
+    def now(self) -> int:
+        return int((self.clock.monotonic() - self.epoch) / self.step_seconds)
+
+    def taken(self, robot: str, cell: int, step: int) -> bool:
+        other = self.slots.get(cell, {}).get(step)
+        if other is not None and other != robot:
+            return True
+        parked = self.parked.get(cell)
+        return parked is not None and parked[0] != robot and step >= parked[1]
+
+    def reserve(self, robot: str, cell: int, step: int):
+        self.slots.setdefault(cell, {})[step] = robot
+        self.routes.setdefault(robot, []).append((cell, step))
+
+    def release(self, robot: str):
+        for cell, step in self.routes.pop(robot, []):
+            steps = self.slots.get(cell)
+            if steps and steps.get(step) == robot:
+                del steps[step]
+                if not steps:
+                    del self.slots[cell]
+        for cell, (owner, _) in list(self.parked.items()):
+            if owner == robot:
+                del self.parked[cell]
+
+    def park(self, robot: str, cell: int):
+        self.release(robot)
+        self.parked[cell] = (robot, self.now())
+
+    def report(self, robot: str, cells: list[int]) -> list[int]:
+        new = [cell for cell in cells if self.graph.cells[cell]]
+        if new:
+            print("Robot %s reported obstacles %s" % (robot, new))
+            self.graph.block(new)
+            self.changes.extend(new)
+        return new
+
+    def duration(self, seconds: float) -> int:
+        return max(1, math.ceil(seconds / self.step_seconds - 1e-9))
+
+    def free(self, robot: str, cell: int, first: int, last: int) -> bool:
+        return not any(
+            self.taken(robot, cell, step) for step in range(first, last + 1)
+        )
+
+    def plan(
+        self, robot: str, start: int, direction: str, dest: int, costs: tuple
+    ) -> tuple[list, list[int], int]:
+        # Returns the motion segments with the step each one starts at,
+        # counted from the returned first step, and the cells passed
+        graph = self.graph
+        distances = search(graph, dest)[0]
+        parked = self.parked.get(dest)
+        if distances[start] == UNREACHABLE or (parked and parked[0] != robot):
+            raise KeyError(dest)
+        self.release(robot)
+        now = self.now()
+        first = now + 1
+        # The destination must stay free once the robot has arrived
+        others = self.slots.get(dest, {})
+        last_taken = max(
+            (step for step, owner in others.items() if owner != robot), default=-1
+        )
+        move, right, left = costs
+        forward = self.duration(move)
+        turn_times = {90: right, -90: left, 180: 2 * right}
+        turns = [
+            (quarters, angle, self.duration(turn_times[angle]))
+            for quarters, angle in TURNS
+        ]
+        steps = [-graph.wid, 1, graph.wid, -1]
+
+        heading = HEADINGS.index(direction)
+        frontier = [(distances[start] * forward, 0, start, heading)]
+        came_from = {(start, heading, 0): None}
+        found = None
+        while frontier:
+            _, offset, cell, heading = heappop(frontier)
+            step = first + offset
+            if cell == dest and step > last_taken:
+                found = (cell, heading, offset)
+                break
+            if offset >= self.horizon:
+                continue
+            actions = [(cell, heading, 1, None)]
+            for quarters, angle, duration in turns:
+                turned = (heading + quarters) % 4
+                actions.append((cell, turned, duration, ("turn", angle)))
+            if graph.cells[cell + steps[heading]]:
+                actions.append((cell + steps[heading], heading, forward, ("fwd", 1)))
+            for next, next_heading, duration, segment in actions:
+                state = (next, next_heading, offset + duration)
+                if state in came_from:
+                    continue
+                if not self.free(robot, cell, step + 1, step + duration):
+                    continue
+                # Entering a cell from the step another robot is still
+                # leaving it covers both swaps and following too closely
+                if next != cell and not self.free(robot, next, step, step + duration):
+                    continue
+                came_from[state] = ((cell, heading, offset), segment)
+                priority = offset + duration + distances[next] * forward
+                heappush(frontier, (priority, offset + duration, next, next_heading))
+
+        if found is None:
+            self.park(robot, start)
+            raise KeyError(dest)
+        moves = []
+        while came_from[found] is not None:
+            previous, segment = came_from[found]
+            moves.append((previous, found, segment))
+            found = previous
+        moves.reverse()
+
+        self.reserve(robot, start, now)
+        self.reserve(robot, start, first)
+        plan = []
+        cells = [start]
+        for (cell, _, offset), (next, _, end), segment in moves:
+            for step in range(first + offset, first + end + 1):
+                self.reserve(robot, cell, step)
+                self.reserve(robot, next, step)
+            if segment is not None:
+                plan.append((offset, *segment))
+            if next != cell:
+                cells.append(next)
+        self.parked[dest] = (robot, first + (moves[-1][1][2] if moves else 0))
+        return plan, cells, first
+
+    def prune(self):
+        now = self.now()
+        for robot, reserved in self.routes.items():
+            self.routes[robot] = [
+                (cell, step) for cell, step in reserved if step >= now
+            ]
+        for cell in list(self.slots):
+            steps = self.slots[cell]
+            for step in [step for step in steps if step < now]:
+                del steps[step]
+            if not steps:
+                del self.slots[cell]
+
+    def handle(self, message: dict) -> dict:
+        with self.lock:
+            op = message.get("op")
+            robot = str(message.get("robot"))
+            if op == "park":
+                self.park(robot, message["cell"])
+                reply = {}
+            elif op == "obstacle":
+                reply = {"blocked": self.report(robot, message["cells"])}
+            elif op == "plan":
+                self.prune()
+                keys = ["start", "direction", "dest", "costs"]
+                route = [message[key] for key in keys]
+                try:
+                    plan, cells, first = self.plan(robot, *route)
+                except KeyError:
+                    reply = {"error": "unreachable"}
+                else:
+                    start_time = self.epoch + first * self.step_seconds
+                    reply = {
+                        "plan": plan,
+                        "cells": cells,
+                        "wait": max(0.0, start_time - self.clock.monotonic()),
+                        "step_seconds": self.step_seconds,
+                    }
+            elif op == "release":
+                self.release(robot)
+                reply = {}
+            else:
+                return {"error": "unknown op %s" % op}
+            known = message.get("version", len(self.changes))
+            reply["changes"] = self.changes[known:]
+            reply["version"] = len(self.changes)
+            return reply
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    # One JSON object per line each way
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.coordinator.handle(json.loads(line))
+            except (ValueError, KeyError) as err:
+                reply = {"error": str(err)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, coordinator: Coordinator, address=("127.0.0.1", FLEET_PORT)):
+        super().__init__(address, CoordinatorHandler)
+        self.coordinator = coordinator
+
+
+class FleetAgent:
+    # Thin client kept by every robot. Obstacles marked on the local graph
+    # go to the coordinator and obstacles found by other robots are
+    # applied to the local graph with every reply.
+    def __init__(self, robot: str, graph: Graph, address=("127.0.0.1", FLEET_PORT)):
+        self.robot = robot
+        self.graph = graph
+        self.version = 0
+        self.applying = False
+        self.lock = threading.Lock()
+        self.sock = socket.create_connection(address)
+        self.file = self.sock.makefile("rwb")
+        graph.listeners.append(self.on_change)
+
+    def call(self, op: str, **message) -> dict:
+        message.update(op=op, robot=self.robot, version=self.version)
+        with self.lock:
+            self.file.write(json.dumps(message).encode("utf-8") + b"\n")
+            self.file.flush()
+            reply = json.loads(self.file.readline())
+        if "version" in reply:
+            self.apply(reply["changes"])
+            self.version = reply["version"]
+        return reply
+
+    def apply(self, cells: list[int]):
+        cells = [cell for cell in cells if self.graph.cells[cell]]
+        if not cells:
+            return
+        self.applying = True
+        try:
+            self.graph.block(cells)
+        finally:
+            self.applying = False
+
+    def on_change(self, cells: list[int]):
+        if not self.applying:
+            self.call("obstacle", cells=cells)
+
+    def park(self, cell: int):
+        self.call("park", cell=cell)
+
+    def plan(self, start: int, direction: str, dest: int, costs: tuple) -> tuple:
+        # Motion segments as (step, kind, amount), the cells passed, seconds
+        # until the first step starts and the length of a step
+        reply = self.call(
+            "plan", start=start, direction=direction, dest=dest, costs=costs
+        )
+        if "error" in reply:
+            raise KeyError(dest)
+        return reply["plan"], reply["cells"], reply["wait"], reply["step_seconds"]
+
+    def close(self):
+        self.graph.listeners.remove(self.on_change)
+        self.file.close()
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the fleet coordinator")
+    parser.add_argument("--size", default="12x15", help="map LENGTHxWIDTH")
+    parser.add_argument("--port", type=int, default=FLEET_PORT)
+    parser.add_argument("--step", type=float, default=STEP_SECONDS)
+    args = parser.parse_args()
+
+    length, width = (int(value) for value in args.size.split("x"))
+    coordinator = Coordinator(Graph(length, width, []), args.step)
+    server = CoordinatorServer(coordinator, ("127.0.0.1", args.port))
+    print("Fleet coordinator on port %d" % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
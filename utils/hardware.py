@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import random
+import time
+
+from utils.robot import MOVE_FWD_TIME, TURN_LFT_TIME, TURN_RGT_TIME
+from utils.simulator import SimClock, SimSensors, SimSerial, SimWorld, random_world
+
+
+class Hardware:
+    # What the control code needs from a robot: a motor connection with
+    # write(), sensors with get_distances() and a clock with sleep().
+    # place(cell, direction) moves a simulated robot, a real one is None.
+    def __init__(self, conn, sensors, clock=time, close=None, place=None):
+        self.conn = conn
+        self.sensors = sensors
+        self.clock = clock
+        self.on_close = close
+        self.place = place
+
+    def close(self):
+        if self.on_close:
+            self.on_close()
+
+
+def open_robot(acknowledged: bool = False) -> Hardware:
+    # Imported here so that the simulator runs without the Pi libraries
+    import RPi.GPIO as GPIO
+    import serial
+
+    from utils.filters import RangeFilter
+    from utils.movement import SETTLE_TIME, SerialTransport
+    from utils.sampler import SensorSampler
+    from utils.ultrasonic import (
+        ECHO_PINS,
+        RANGE_NAMES,
+        TRIGGER_PINS,
+        Rangefinder,
+        RangefinderArray,
+    )
+
+    GPIO.setmode(GPIO.BCM)
+    serial_port = serial.Serial("/dev/ttyACM0", 9600, timeout=1)
+    serial_port.flush()
+    conn = SerialTransport(serial_port, acknowledged=acknowledged, settle=SETTLE_TIME)
+    conn.start()
+
+    rangefinders = {}
+    for trigger, echo, name in zip(TRIGGER_PINS, ECHO_PINS, RANGE_NAMES):
+        rangefinders[name] = Rangefinder(trigger, echo, edge=True)
+    sensors = SensorSampler(
+        RangefinderArray(rangefinders),
+        filters={name: RangeFilter() for name in RANGE_NAMES},
+    )
+    sensors.start()
+
+    def close():
+        conn.stop()
+        sensors.stop()
+        serial_port.close()
+        GPIO.cleanup()
+
+    return Hardware(conn, sensors, time, close)
+
+
+def open_simulator(
+    length: int,
+    width: int,
+    start: int,
+    direction: str,
+    density: float = 0.05,
+    realtime: bool = True,
+    seed: int = None,
+) -> Hardware:
+    truth = random_world(length, width, density, random.Random(seed))
+    # Never start inside a wall
+    for cell in [start, start - 1, start + 1, start - width, start + width]:
+        if 0 < cell % width < width - 1 and 0 < cell // width < length - 1:
+            truth.cells[cell] = 1
+    world = SimWorld(truth, MOVE_FWD_TIME, TURN_RGT_TIME, TURN_LFT_TIME, seed=seed)
+    world.place(start, direction)
+    return Hardware(
+        SimSerial(world),
+        SimSensors(world),
+        SimClock(world, realtime),
+        place=world.place,
+    )
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import csv
+import os
+
+from utils.pathing import Graph
+
+# Image pixels darker than this are obstacles, as in ROS map images
+THRESHOLD = 128
+
+
+def darker_than(cut: float) -> bytes:
+    # Translation table from pixel value to 1 for an obstacle
+    return bytes(value < cut for value in range(256))
+
+
+def read_csv(path: str) -> tuple[int, int, bytes]:
+    # One row of the map per line, non-zero for an obstacle
+    with open(path, newline="") as file:
+        rows = [row for row in csv.reader(file) if row]
+    blocked = bytes(1 if float(value) else 0 for row in rows for value in row)
+    return len(rows), len(rows[0]), blocked
+
+
+def read_pgm(path: str, threshold: int = THRESHOLD) -> tuple[int, int, bytes]:
+    with open(path, "rb") as file:
+        data = file.read()
+    # Header fields are separated by whitespace and may carry comments
+    fields = []
+    position = 0
+    while len(fields) < 4:
+        while data[position : position + 1].isspace():
+            position += 1
+        if data[position : position + 1] == b"#":
+            position = data.index(b"\n", position)
+            continue
+        end = position
+        while not data[end : end + 1].isspace():
+            end += 1
+        fields.append(data[position:end])
+        position = end
+    magic, width, length, maxval = fields[0], *map(int, fields[1:])
+    if magic == b"P5":
+        if maxval > 255:
+            raise ValueError("16 bit PGM maps are not supported")
+        pixels = data[position + 1 : position + 1 + length * width]
+    elif magic == b"P2":
+        pixels = bytes(
+            value * 255 // maxval
+            for value in map(int, data[position:].split()[: length * width])
+        )
+        maxval = 255
+    else:
+        raise ValueError("%s is not a PGM image" % path)
+    return length, width, pixels.translate(darker_than(threshold * maxval / 255))
+
+
+def read_png(path: str, threshold: int = THRESHOLD) -> tuple[int, int, bytes]:
+    # Needs Pillow, which the robot itself does not
+    from PIL import Image
+
+    with Image.open(path) as image:
+        gray = image.convert("L")
+        width, length = gray.size
+        pixels = gray.tobytes()
+    return length, width, pixels.translate(darker_than(threshold))
+
+
+def read_npy(path: str) -> tuple[int, int, bytes]:
+    import numpy
+
+    grid = numpy.load(path)
+    length, width = grid.shape
+    return length, width, (grid != 0).astype("uint8").tobytes()
+
+
+READERS = {
+    ".csv": read_csv,
+    ".pgm": read_pgm,
+    ".png": read_png,
+    ".npy": read_npy,
+}
+
+
+def load_map(path: str, radius: int = 1, incremental: bool = False) -> Graph:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError("Unknown map format %s" % extension)
+    length, width, blocked = READERS[extension](path)
+    return Graph.from_blocked(length, width, blocked, radius, incremental)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import math
+import mmap
+import os
+import struct
+import zlib
+
+from utils.pathing import Graph
+
+# magic, version, length, width, crc32 of the map the snapshot started from,
+# move_fwd_time, turn_rgt_time, turn_lft_time
+HEADER = struct.Struct("<4sHHHIddd")
+MAGIC = b"CFSM"
+VERSION = 2
+CALIBRATION_OFFSET = struct.calcsize("<4sHHHI")
+CALIBRATION = struct.Struct("<ddd")
+
+
+class MapStore:
+    # Snapshot of the graph occupancy and the robot calibration. The file is
+    # memory mapped and the graph works on the mapped bytes directly, so a
+    # marked obstacle only dirties the page it lives on.
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.cells = None
+
+    def header(self, length: int, width: int) -> tuple:
+        # (base crc32, calibration) of a snapshot of this size, else None
+        if not os.path.exists(self.path):
+            return None
+        if os.path.getsize(self.path) != HEADER.size + length * width:
+            return None
+        with open(self.path, "rb") as file:
+            magic, version, saved_length, saved_width, checksum, *calibration = (
+                HEADER.unpack(file.read(HEADER.size))
+            )
+        if (magic, version, saved_length, saved_width) != (
+            MAGIC,
+            VERSION,
+            length,
+            width,
+        ):
+            return None
+        return checksum, calibration
+
+    def matches(self, length: int, width: int) -> bool:
+        return self.header(length, width) is not None
+
+    def open(
+        self,
+        length: int,
+        width: int,
+        obstacles: list[int],
+        incremental: bool = False,
+        base: Graph = None,
+        reset: bool = False,
+    ) -> Graph:
+        # A new snapshot starts from base when given, else from obstacles.
+        # The snapshot only adds obstacles to that map, so when the map it
+        # started from has changed since, e.g. a new survey, it is started
+        # again from the new one and only the calibration is kept. reset
+        # does the same on purpose, to drop obstacles that were marked or
+        # mapped in by mistake, which nothing else ever clears.
+        if base is None:
+            base = Graph(length, width, obstacles)
+        checksum = zlib.crc32(base.cells)
+        header = self.header(length, width)
+        if header is None:
+            print("Creating map snapshot %s" % self.path)
+            self.write(length, width, base, checksum, [0.0, 0.0, 0.0])
+        elif header[0] != checksum or reset:
+            if reset:
+                print("Resetting map snapshot %s" % self.path)
+            else:
+                print("Map changed since snapshot %s, starting it again" % self.path)
+            self.write(length, width, base, checksum, header[1])
+
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), HEADER.size + length * width)
+        self.cells = memoryview(self.map)[HEADER.size :]
+        graph = Graph(length, width, obstacles, incremental, cells=self.cells)
+        graph.listeners.append(self.on_change)
+        return graph
+
+    def write(
+        self, length: int, width: int, base: Graph, checksum: int, calibration
+    ):
+        with open(self.path, "wb") as file:
+            file.write(
+                HEADER.pack(MAGIC, VERSION, length, width, checksum, *calibration)
+            )
+            file.write(base.cells)
+
+    def on_change(self, cells: list[int]):
+        # Only the dirty pages are written back
+        self.map.flush()
+
+    def load_calibration(self, robot) -> bool:
+        values = CALIBRATION.unpack_from(self.map, CALIBRATION_OFFSET)
+        # nan is truthy, a snapshot saved from a bad calibration is ignored
+        if not all(math.isfinite(value) and value > 0 for value in values):
+            return False
+        robot.move_fwd_time, robot.turn_rgt_time, robot.turn_lft_time = values
+        return True
+
+    def save_calibration(self, robot):
+        CALIBRATION.pack_into(
+            self.map,
+            CALIBRATION_OFFSET,
+            robot.move_fwd_time,
+            robot.turn_rgt_time,
+            robot.turn_lft_time,
+        )
+        self.map.flush()
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.cells.release()
+        self.map.close()
+        self.file.close()
+        self.map = None
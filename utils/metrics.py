@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import functools
+import math
+import threading
+import time
+
+# Each power of two is split into this many linear sub-buckets, which keeps
+# the relative error of a recorded value under 1 / SUB_BUCKETS
+SUB_BUCKETS = 16
+# Smallest value told apart from zero, in seconds
+RESOLUTION = 1e-6
+# Bucket bounds reported to Prometheus, in seconds
+EXPORT_BUCKETS = [
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+]
+
+
+class Histogram:
+    # Log-linear (HDR style) histogram, recording is a frexp and a dict bump
+    def __init__(self, name: str, help: str = "", labels: dict = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def index(self, value: float) -> int:
+        if value < RESOLUTION:
+            return 0
+        mantissa, exponent = math.frexp(value / RESOLUTION)
+        return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS) + 1
+
+    def upper_bound(self, index: int) -> float:
+        if index == 0:
+            return RESOLUTION
+        exponent, sub = divmod(index - 1, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), exponent) * RESOLUTION
+
+    def record(self, value: float):
+        index = self.index(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q: float) -> float:
+        with self.lock:
+            counts = sorted(self.counts.items())
+            total = self.count
+        if not total:
+            return 0.0
+        seen = 0
+        for index, count in counts:
+            seen += count
+            if seen >= q * total:
+                return self.upper_bound(index)
+        return self.upper_bound(counts[-1][0])
+
+    def render(self) -> list[str]:
+        with self.lock:
+            counts = sorted(self.counts.items())
+            total = self.count
+            sum = self.sum
+        lines = []
+        seen = 0
+        position = 0
+        for bound in EXPORT_BUCKETS:
+            while position < len(counts):
+                index, count = counts[position]
+                if self.upper_bound(index) > bound:
+                    break
+                seen += count
+                position += 1
+            lines.append(
+                "%s_bucket%s %d" % (self.name, self.format_labels(le=bound), seen)
+            )
+        lines.append(
+            "%s_bucket%s %d" % (self.name, self.format_labels(le="+Inf"), total)
+        )
+        lines.append("%s_sum%s %.9f" % (self.name, self.format_labels(), sum))
+        lines.append("%s_count%s %d" % (self.name, self.format_labels(), total))
+        return lines
+
+    def format_labels(self, **extra) -> str:
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % item for item in labels.items())
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, help: str = "", **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    key, Histogram(name, help, labels)
+                )
+        return histogram
+
+    def render(self) -> str:
+        lines = []
+        written = set()
+        # New labelled histograms are added while a trip runs
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for (name, _), histogram in histograms:
+            if name not in written:
+                written.add(name)
+                lines.append("# HELP %s %s" % (name, histogram.help))
+                lines.append("# TYPE %s histogram" % name)
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def histogram(name: str, help: str = "", **labels) -> Histogram:
+    return REGISTRY.histogram(name, help, **labels)
+
+
+def timed(name: str, help: str = ""):
+    # Decorator recording the run time of every call
+    def decorator(function):
+        target = histogram(name, help)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                target.record(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
@@ -1,12 +1,132 @@
 #!/usr/bin/env python3
+import itertools
+import queue
 import serial
+import threading
 import time
 
+# Frames that may wait for an acknowledgement before send() blocks
+WINDOW = 4
+ACK_TIMEOUT = 1.0
+# The board resets when the port is opened and misses what comes meanwhile
+SETTLE_TIME = 1.0
+
 
 def SendCmd(conn, cmd: str):
     conn.write(cmd)
 
 
+class SerialTransport:
+    # Writes motor commands from a background thread so callers never block
+    # on the port. In acknowledged mode each frame is "<seq> <CMD> [ms]\n",
+    # the firmware answers "ACK <seq>" and at most WINDOW frames are in flight.
+    # The plain mode keeps the old "<CMD>\n" protocol.
+    def __init__(
+        self,
+        conn,
+        acknowledged: bool = False,
+        window: int = WINDOW,
+        settle: float = 0.0,
+    ):
+        self.conn = conn
+        self.acknowledged = acknowledged
+        # Frames sent before the board is up wait in the queue, not the caller
+        self.settle = settle
+        self.frames = queue.Queue()
+        self.window = threading.BoundedSemaphore(window)
+        self.sequence = itertools.count(1)
+        # Sequence numbers are handed out and queued under one lock, so
+        # frames of concurrent senders go out in order
+        self.sending = threading.Lock()
+        self.sent = 0
+        self.acked = 0
+        self.acks = threading.Condition()
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.reader = threading.Thread(target=self.read_acks, daemon=True)
+
+    def start(self):
+        self.writer.start()
+        if self.acknowledged:
+            self.reader.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.frames.put(None)
+        if self.writer.is_alive():
+            self.writer.join()
+
+    def send(self, cmd: bytes, duration: float = None) -> int:
+        # With a duration the firmware stops the motors on its own,
+        # e.g. b"7 FWD 448\n" drives forward for 448 ms
+        frame = cmd.strip()
+        if duration is not None:
+            frame += b" %d" % round(duration * 1000)
+        if self.acknowledged:
+            # Back-pressure, wait until the firmware caught up
+            if not self.window.acquire(timeout=ACK_TIMEOUT):
+                self.resync()
+                self.window.acquire()
+        with self.sending:
+            seq = next(self.sequence)
+            if self.acknowledged:
+                frame = b"%d " % seq + frame
+                self.sent = seq
+            self.frames.put(frame + b"\n")
+        return seq
+
+    def resync(self):
+        # No acknowledgement came within ACK_TIMEOUT, the frames in flight
+        # are taken as lost so that a dropped frame or a dead reader does
+        # not block every sender, the /stop handler included
+        with self.acks:
+            lost = self.sent - self.acked
+            print("No ACK after %d, dropping %d frames" % (self.acked, lost))
+            for _ in range(lost):
+                self.window.release()
+            self.acked = self.sent
+            self.acks.notify_all()
+
+    def write(self, cmd: bytes):
+        # Same call as serial.Serial.write, so send_cmd works unchanged
+        self.send(cmd)
+
+    def wait(self, seq: int, timeout: float = ACK_TIMEOUT) -> bool:
+        if not self.acknowledged:
+            return True
+        with self.acks:
+            return self.acks.wait_for(lambda: self.acked >= seq, timeout)
+
+    def write_frames(self):
+        self.stopped.wait(self.settle)
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.conn.write(frame)
+
+    def read_acks(self):
+        while not self.stopped.is_set():
+            line = self.conn.readline().decode("utf-8", "replace").strip()
+            if not line.startswith("ACK "):
+                if line:
+                    print(line)
+                continue
+            try:
+                seq = int(line.split()[1])
+            except (IndexError, ValueError):
+                print("Bad acknowledgement %r" % line)
+                continue
+            with self.acks:
+                # Acknowledgements are cumulative. An ACK past the last
+                # frame sent would free slots that were never taken.
+                seq = min(seq, self.sent)
+                for _ in range(seq - self.acked):
+                    self.window.release()
+                self.acked = max(self.acked, seq)
+                self.acks.notify_all()
+
+
 if __name__ == "__main__":
     ser = serial.Serial("/dev/ttyACM0", 9600, timeout=1)
     ser.flush()
@@ -42,9 +162,3 @@ if __name__ == "__main__":
         print(line)
         time.sleep(4)
 
-
-def SendCmd(conn: Serial, cmd: str):
-    conn.write(cmd)
-    line = conn.readline().decode("utf-8").rstrip()
-    print(line)
-    return
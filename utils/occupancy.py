@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+from utils.robot import CELL_SIZE, HEADINGS, RANGE_ANGLES
+
+# Log odds added to the cell a reading ends in and to every cell it passes
+HIT = 0.9
+MISS = -0.4
+# Evidence is clamped so that a cell can still change its mind
+LIMIT = 4.0
+# Cells this sure to be occupied (about 88%) are blocked in the graph
+BLOCK = 2.0
+# Readings beyond this are not trusted to have found anything, in cm
+FREE_RANGE = 100.0
+
+
+class OccupancyGrid:
+    # Log-odds occupancy under a Graph. Every reading of every rangefinder
+    # is cast as a ray from the robot: the cells it passes become more
+    # likely free, the cell it ends in more likely occupied. Cells that
+    # cross BLOCK are blocked in the graph, ahead of the robot reaching
+    # them. The graph only ever gains obstacles, so free evidence never
+    # unblocks a cell; with a MapStore it stays blocked until the snapshot
+    # is reset. A blocked cell is grown by radius cells like the
+    # obstacles of the graph are, so routes keep the robot off of it.
+    def __init__(
+        self,
+        graph,
+        cell_size: float = CELL_SIZE,
+        angles: dict = None,
+        radius: int = 1,
+    ):
+        self.graph = graph
+        self.cell_size = cell_size
+        self.angles = RANGE_ANGLES if angles is None else angles
+        self.log_odds = [0.0] * len(graph.cells)
+        # (row, col) offsets of the disc a blocked cell is grown to
+        self.disc = [
+            (d_row, d_col)
+            for d_row in range(-radius, radius + 1)
+            for d_col in range(-radius, radius + 1)
+            if d_row * d_row + d_col * d_col <= radius * radius
+        ]
+
+    def add(self, cell: int, evidence: float):
+        self.log_odds[cell] = max(-LIMIT, min(LIMIT, self.log_odds[cell] + evidence))
+
+    def update(self, cell: int, direction: str, readings: dict) -> list[int]:
+        # readings as given by get_distances, taken with the robot in the
+        # middle of cell facing direction. Returns the newly blocked cells.
+        graph = self.graph
+        row, col = divmod(cell, graph.wid)
+        heading = HEADINGS[direction]
+        hits = set()
+        for name, distance in readings.items():
+            if name not in self.angles:
+                continue
+            found = distance < FREE_RANGE
+            length = (distance if found else FREE_RANGE) / self.cell_size
+            _, passed, known = graph.cast_ray(
+                col + 0.5, row + 0.5, heading + self.angles[name], length
+            )
+            # A ray stopped by a known obstacle says nothing new about it
+            if found and known is None and passed:
+                hits.add(passed.pop())
+            for free in passed:
+                self.add(free, MISS)
+        for hit in hits:
+            self.add(hit, HIT)
+
+        grown = set()
+        for hit in hits:
+            if hit == cell or not graph.cells[hit] or self.log_odds[hit] < BLOCK:
+                continue
+            hit_row, hit_col = divmod(hit, graph.wid)
+            for d_row, d_col in self.disc:
+                next_row, next_col = hit_row + d_row, hit_col + d_col
+                if 0 <= next_row < graph.len and 0 <= next_col < graph.wid:
+                    grown.add(next_row * graph.wid + next_col)
+        # The robot's own cell stays free, it is standing on it
+        blocked = [next for next in sorted(grown) if next != cell and graph.cells[next]]
+        if blocked:
+            print("Occupancy grid blocks %s" % blocked)
+            graph.block(blocked)
+        return blocked
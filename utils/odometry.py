@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import math
+
+from utils.robot import CELL_SIZE, HEADINGS, RANGE_ANGLES
+
+# Walls further than this are not used to measure progress, in cm
+ODOMETRY_RANGE = 150.0
+# A reading this close to the map is taken to see the known wall, in cells
+TOLERANCE = 0.4
+# Heading errors smaller than this are left alone, in degrees, and how far
+# a wall may be to measure them on, in cm
+HEADING_TOLERANCE = 3.0
+HEADING_RANGE = 400.0
+# Range checks per cell while driving to a wall, and how long past
+# move_fwd_time a cell may take before the timer wins after all
+STEPS_PER_CELL = 20
+TIMEOUT = 1.5
+# Readings in a row that have to be in range before a cell is over
+CONFIRM = 3
+# Heading errors a scan is matched over, in degrees either way, the coarse
+# and the fine step between two tries, and how many rangefinders have to
+# agree with the map
+SCAN_RANGE = 25
+SCAN_STEP = 2.5
+SCAN_FINE_STEP = 0.5
+SCAN_MATCHES = 3
+# Offsets from the middle of the cell a scan is matched at, in cells. The
+# timer leaves the robot a few cm off the middle, which would otherwise
+# push most readings out of TOLERANCE.
+SCAN_OFFSETS = [-0.3, -0.15, 0.0, 0.15, 0.3]
+
+
+class RangeOdometry:
+    # Dead reckoning against the walls the graph already knows. The fwd
+    # range to a known wall tells how far the robot got along a run, and
+    # the ranges of left_30 and rgt_30 to the same wall how far it turned
+    # away from its heading.
+    def __init__(self, graph, cell_size: float = CELL_SIZE):
+        self.graph = graph
+        self.cell_size = cell_size
+
+    def cast(
+        self, cell: int, direction: str, name: str, limit: float = ODOMETRY_RANGE
+    ) -> tuple:
+        # Distance in cm from the middle of cell to the known wall seen by
+        # the named rangefinder and the wall cell, or None beyond limit cm
+        row, col = divmod(cell, self.graph.wid)
+        angle = HEADINGS[direction] + RANGE_ANGLES[name]
+        limit = limit / self.cell_size
+        distance, _, hit = self.graph.cast_ray(col + 0.5, row + 0.5, angle, limit)
+        if hit is None:
+            return None
+        return distance * self.cell_size, hit
+
+    def expected(self, cell: int, direction: str) -> float:
+        wall = self.cast(cell, direction, "fwd")
+        return None if wall is None else wall[0]
+
+    def sees_wall(self, cell: int, direction: str, reading: float) -> bool:
+        expected = self.expected(cell, direction)
+        return (
+            expected is not None
+            and abs(reading - expected) <= TOLERANCE * self.cell_size
+        )
+
+    def heading_error(self, cell: int, direction: str, distances: dict) -> float:
+        # Degrees the robot is turned clockwise from direction, or None
+        # when there is no flat known wall ahead to measure it on
+        names = ["left_30", "fwd", "rgt_30"]
+        walls = [self.cast(cell, direction, name, HEADING_RANGE) for name in names]
+        if None in walls:
+            return None
+        # The three rays have to end on the same wall across the heading
+        along = 0 if direction in "NS" else 1
+        if len({divmod(hit, self.graph.wid)[along] for _, hit in walls}) != 1:
+            return None
+        left, fwd, right = (distances[name] for name in names)
+        if not all(map(math.isfinite, [left, fwd, right])):
+            return None
+
+        # Turned by e, the rays at -30 and +30 meet the wall at e - 30 and
+        # e + 30 from its normal, so tan(e) = (right - left) / (right + left)
+        # / tan(30)
+        ratio = (right - left) / (right + left)
+        error = math.atan(ratio / math.tan(math.radians(30)))
+        square = fwd * math.cos(error)
+        tolerance = TOLERANCE * self.cell_size
+        if abs(square - walls[1][0]) > tolerance:
+            return None
+        for reading, angle in [(left, -30), (right, 30)]:
+            slant = square / math.cos(error + math.radians(angle))
+            if abs(reading - slant) > tolerance:
+                return None
+        return math.degrees(error)
+
+    def scan_heading_error(self, cell: int, direction: str, distances: dict) -> float:
+        # Degrees the robot is turned clockwise from direction, found by
+        # turning the known map under all the readings at once. Needs no
+        # flat wall, only SCAN_MATCHES rangefinders that end on any known
+        # wall. The pose most of them agree on best is searched in coarse
+        # steps over SCAN_OFFSETS, then refined in fine steps around it.
+        # None when too few of them see the map.
+        readings = [
+            (HEADINGS[direction] + RANGE_ANGLES[name], distance)
+            for name, distance in distances.items()
+            if name in RANGE_ANGLES and distance <= HEADING_RANGE
+        ]
+        if len(readings) < SCAN_MATCHES:
+            return None
+        row, col = divmod(cell, self.graph.wid)
+        coarse = round(SCAN_RANGE / SCAN_STEP)
+        best = None
+        for d_row in SCAN_OFFSETS:
+            for d_col in SCAN_OFFSETS:
+                x, y = col + 0.5 + d_col, row + 0.5 + d_row
+                for step in range(-coarse, coarse + 1):
+                    error = step * SCAN_STEP
+                    score = self.match(x, y, error, readings) + (-abs(error),)
+                    if best is None or score > best[0]:
+                        best = (score, x, y, error)
+        score, x, y, center = best
+        fine = round(SCAN_STEP / SCAN_FINE_STEP)
+        for step in range(-fine, fine + 1):
+            error = center + step * SCAN_FINE_STEP
+            if step and abs(error) <= SCAN_RANGE:
+                refined = self.match(x, y, error, readings) + (-abs(error),)
+                if refined > score:
+                    score, best = refined, (refined, x, y, error)
+        if score[0] < SCAN_MATCHES:
+            return None
+        return best[3]
+
+    def match(self, x: float, y: float, error: float, readings: list) -> tuple:
+        # (readings within TOLERANCE of the map, minus their summed miss)
+        # for the robot at (x, y) in cells, turned by error degrees
+        tolerance = TOLERANCE * self.cell_size
+        limit = HEADING_RANGE / self.cell_size
+        matches = 0
+        residual = 0.0
+        for angle, reading in readings:
+            distance, _, hit = self.graph.cast_ray(x, y, angle + error, limit)
+            if hit is not None:
+                miss = abs(reading - distance * self.cell_size)
+                if miss <= tolerance:
+                    matches += 1
+                    residual += miss
+        return (matches, -residual)
@@ -1,151 +1,443 @@
 #!/usr/bin/env python3
-import itertools
+import math
 
-from queue import PriorityQueue
+from heapq import heappop, heappush
+from utils.metrics import timed
+
+INF = float("inf")
+# Headings in clockwise order, a right turn is +1 and a left turn -1
+HEADINGS = "NESW"
+TURNS = {"rgt": 90, "lft": -90}
+# Cell bytes to bit characters and back: any non-zero byte is an obstacle
+TO_BITS = bytes([48] + [49] * 255)
+FROM_BITS = bytes(1 if value == 48 else 0 for value in range(256))
+# Cells D* Lite looks at around the robot before a repair, a robot walled
+# into fewer cells than this is answered without searching from the goal
+REACH_CHECK = 1024
 
 
 class Node:
-    def __init__(self, id: int):
-        self.id: int = id
-        self.children: list[Node] = []
-        self.previous = None
+    # Nodes are views of a single cell of the graph occupancy grid.
+    # They are created on demand and compare equal by cell.
+    __slots__ = ("graph", "cell")
+
+    def __init__(self, graph: "Graph", cell: int):
+        self.graph = graph
+        self.cell = cell
 
-    def add_child(self, child):
-        self.children.append(child)
+    @property
+    def id(self) -> int:
+        return self.cell if self.graph.cells[self.cell] else -1
 
-    def remove_child(self, child):
-        self.children.remove(child)
+    @property
+    def children(self) -> list["Node"]:
+        return [Node(self.graph, cell) for cell in self.get_children_id()]
 
     def get_id(self) -> int:
         return self.id
 
     def get_children_id(self) -> list[int]:
-        return [child.get_id() for child in self.children]
+        if not self.graph.cells[self.cell]:
+            return []
+        return list(self.graph.neighbours(self.cell))
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Node)
+            and self.cell == other.cell
+            and self.graph is other.graph
+        )
+
+    def __hash__(self):
+        return hash(self.cell)
+
+    def __repr__(self):
+        return "Node(%d)" % self.id
 
 
 class Graph:
-    def __init__(self, length: int, width: int, obstacles: list[int]):
+    def __init__(
+        self,
+        length: int,
+        width: int,
+        obstacles: list[int],
+        incremental: bool = False,
+        cells=None,
+    ):
         self.len = length
         self.wid = width
-        self.nodes = []
-
-        extended_obstacles = []
-        extended_obstacles.extend(obstacles)
-
+        # With incremental planning build_path keeps a D* Lite search towards
+        # the last destination and repairs it when obstacles are marked
+        self.incremental = incremental
+        self.planner = None
+        # Called with the list of newly blocked cells after mark_as_obstacle
+        self.listeners = []
+        # Landmark distance tables that sharpen the A* heuristic (ALT),
+        # -1 marks a cell the landmark cannot reach
+        self.landmarks = []
+
+        if cells is not None:
+            # Occupancy loaded from a snapshot, obstacles are already in it
+            self.cells = cells
+            return
+
+        # One byte per cell, 1 for free and 0 for blocked. The outer ring
+        # is never part of the map, so neighbours need no bounds checks.
+        size = length * width
+        self.cells = bytearray(b"\x01") * size
+        self.cells[:width] = bytes(width)
+        self.cells[size - width :] = bytes(width)
+        self.cells[::width] = bytes(length)
+        self.cells[width - 1 :: width] = bytes(length)
+
+        extended_obstacles = set(obstacles)
         for node in obstacles:
-            if node - 1 not in extended_obstacles:
-                extended_obstacles.append(node - 1)
-            if node + 1 not in extended_obstacles:
-                extended_obstacles.append(node + 1)
-            if node - width not in extended_obstacles:
-                extended_obstacles.append(node - width)
-            if node + width not in extended_obstacles:
-                extended_obstacles.append(node + width)
-
-        extended_obstacles.sort()
-
-        print(extended_obstacles)
-
-        for i in range(1, length - 1):
-            row = []
-            for j in range(1, width - 1):
-                if i * width + j not in extended_obstacles:
-                    node = Node(i * width + j)
-                else:
-                    node = Node(-1)
-                row.append(node)
-            self.nodes.append(row)
-
-        graph_nodes_id = list(
-            itertools.chain.from_iterable(
-                [[node.get_id() for node in row] for row in self.nodes]
-            )
-        )
-
-        for row in self.nodes:
-            for node in row:
-                possible_children = [
-                    node.id - 1,
-                    node.id + 1,
-                    node.id - width,
-                    node.id + width,
-                ]
-                for possible_child in possible_children:
-                    if possible_child in graph_nodes_id:
-                        node.add_child(self.get_node_by_id(possible_child))
+            extended_obstacles.update((node - 1, node + 1, node - width, node + width))
+
+        print(sorted(extended_obstacles))
+
+        for cell in extended_obstacles:
+            if 0 <= cell < size:
+                self.cells[cell] = 0
+
+    @classmethod
+    def from_blocked(
+        cls,
+        length: int,
+        width: int,
+        blocked: bytes,
+        radius: int = 1,
+        incremental: bool = False,
+    ) -> "Graph":
+        # blocked has one byte per cell, row by row, non-zero for an obstacle
+        cells = bytearray(dilate(blocked, length, width, radius))
+        cells[:width] = bytes(width)
+        cells[len(cells) - width :] = bytes(width)
+        cells[::width] = bytes(length)
+        cells[width - 1 :: width] = bytes(length)
+        return cls(length, width, [], incremental, cells=cells)
+
+    @classmethod
+    def from_occupancy(
+        cls, grid, radius: int = 1, incremental: bool = False
+    ) -> "Graph":
+        # grid is a 2D NumPy array or a list of rows, non-zero for an obstacle
+        if hasattr(grid, "shape"):
+            length, width = grid.shape
+            blocked = (grid != 0).astype("uint8").tobytes()
+        else:
+            length, width = len(grid), len(grid[0])
+            blocked = bytes(1 if value else 0 for row in grid for value in row)
+        return cls.from_blocked(length, width, blocked, radius, incremental)
+
+    @property
+    def nodes(self) -> list[list[Node]]:
+        return [
+            [Node(self, i * self.wid + j) for j in range(1, self.wid - 1)]
+            for i in range(1, self.len - 1)
+        ]
+
+    def neighbours(self, cell: int):
+        cells = self.cells
+        for possible_child in (cell - 1, cell + 1, cell - self.wid, cell + self.wid):
+            if cells[possible_child]:
+                yield possible_child
 
     def get_node_by_id(self, id: int) -> Node:
-        for row in self.nodes:
-            for node in row:
-                if node.get_id() == id:
-                    return node
+        if 0 <= id < len(self.cells) and self.cells[id]:
+            return Node(self, id)
+        return None
+
+    def nearest_free(self, cell: int) -> Node:
+        # Free cell closest to cell in steps over the whole grid, blocked or
+        # not, so a start cell that has since been marked still finds one.
+        # None when the map has no free cell at all.
+        size = len(self.cells)
+        seen = {cell}
+        frontier = [cell]
+        while frontier:
+            next_frontier = []
+            for current in frontier:
+                if 0 <= current < size and self.cells[current]:
+                    return Node(self, current)
+                row, col = divmod(current, self.wid)
+                for next_row, next_col in [
+                    (row - 1, col),
+                    (row + 1, col),
+                    (row, col - 1),
+                    (row, col + 1),
+                ]:
+                    next = next_row * self.wid + next_col
+                    if (
+                        0 <= next_row < self.len
+                        and 0 <= next_col < self.wid
+                        and next not in seen
+                    ):
+                        seen.add(next)
+                        next_frontier.append(next)
+            frontier = next_frontier
         return None
 
     def mark_as_obstacle(self, target: Node, direction: str):
         obstacles = [target]
         print(direction)
         if direction in ["N", "S"]:
-            if self.get_node_by_id(target.id - 1):
-                obstacles.append(self.get_node_by_id(target.id - 1))
-            if self.get_node_by_id(target.id + 1):
-                obstacles.append(self.get_node_by_id(target.id + 1))
+            sides = [target.cell - 1, target.cell + 1]
         else:
-            if self.get_node_by_id(target.id - self.wid):
-                obstacles.append(self.get_node_by_id(target.id - self.wid))
-            if self.get_node_by_id(target.id + self.wid):
-                obstacles.append(self.get_node_by_id(target.id + self.wid))
+            sides = [target.cell - self.wid, target.cell + self.wid]
+        for side in sides:
+            node = self.get_node_by_id(side)
+            if node:
+                obstacles.append(node)
         for obstacle in obstacles:
-            print({obstacle.id: [node.id for node in obstacle.children]})
-            for node in obstacle.children:
-                node.remove_child(obstacle)
-            obstacle.id = -1
+            print({obstacle.id: obstacle.get_children_id()})
+        self.block([obstacle.cell for obstacle in obstacles])
         return obstacles
 
-    def build_path(self, start: Node, dest: Node) -> list[Node]:
-        frontier = PriorityQueue()
-        frontier.put((0, start.id))
-        came_from = {}
-        cost_so_far = {}
-        came_from[start] = Node(-1)
-        cost_so_far[start] = 0
-
-        while not frontier.empty():
-            current = self.get_node_by_id(frontier.get()[1])
-
-            if current == dest:
+    def block(self, cells: list[int]):
+        for cell in cells:
+            self.cells[cell] = 0
+        if self.planner:
+            self.planner.update(cells)
+        for listener in self.listeners:
+            listener(cells)
+
+    @timed("build_path_seconds", "Time of planning one path")
+    def build_path(
+        self, start: Node, dest: Node, direction: str = None, costs: tuple = None
+    ) -> list[Node]:
+        # With costs the route is planned for time, which wins over the
+        # incremental mode: only routes by cell count are repaired by D* Lite
+        if costs is not None:
+            return self.build_timed_path(start, dest, direction, costs)
+        if self.incremental:
+            if self.planner is None or self.planner.goal != dest.cell:
+                self.planner = DStarLite(self, dest.cell)
+            return [Node(self, cell) for cell in self.planner.plan(start.cell)]
+
+        goal = dest.cell
+        estimate = self.landmark_distance if self.landmarks else self.distance
+        frontier = [(0, start.cell)]
+        came_from = {start.cell: -1}
+        cost_so_far = {start.cell: 0}
+
+        while frontier:
+            current = heappop(frontier)[1]
+
+            if current == goal:
                 break
 
-            for next in current.children:
-                new_cost = cost_so_far[current] + 1
+            new_cost = cost_so_far[current] + 1
+            for next in self.neighbours(current):
                 if next not in cost_so_far or new_cost < cost_so_far[next]:
                     cost_so_far[next] = new_cost
-                    priority = new_cost + self.heuristic(dest, next)
-                    frontier.put((priority, next.id))
+                    priority = new_cost + estimate(goal, next)
+                    heappush(frontier, (priority, next))
                     came_from[next] = current
 
-        current = dest
-        path = [current]
-        while came_from[current].id != -1:
-            path.append(came_from[current])
-            current = came_from[current]
+        path = [goal]
+        while came_from[path[-1]] != -1:
+            path.append(came_from[path[-1]])
 
         path.reverse()
 
-        return path
+        return [Node(self, cell) for cell in path]
+
+    def build_timed_path(
+        self, start: Node, dest: Node, direction: str, costs: tuple
+    ) -> list[Node]:
+        # A* over (cell, heading) states, so turns cost time like driving
+        # does. costs are the seconds of one fwd, one rgt and one lft
+        # command. Every step turns the way create_command_sequence will
+        # (an about-turn is two rgt) and then drives one cell.
+        move, right, left = costs
+        wid = self.wid
+        cells = self.cells
+        offsets = [(-1, 0), (0, 1), (1, 0), (0, -1)]
+        steps = [row * wid + col for row, col in offsets]
+        turn_costs = [0, right, 2 * right, left]
+        least_turn = min(right, left)
+        goal = dest.cell
+        goal_row, goal_col = divmod(goal, wid)
+
+        def estimate(cell: int, heading: int) -> float:
+            row, col = divmod(cell, wid)
+            d_row, d_col = goal_row - row, goal_col - col
+            cost = (abs(d_row) + abs(d_col)) * move
+            step_row, step_col = offsets[heading]
+            # Quarter turns still needed: none with the goal straight ahead,
+            # one when it is ahead or beside, two when it is behind
+            ahead = d_row * step_row + d_col * step_col
+            beside = d_row * step_col - d_col * step_row
+            if ahead > 0:
+                if beside:
+                    cost += least_turn
+            elif beside:
+                cost += least_turn if ahead == 0 else 2 * least_turn
+            elif ahead < 0:
+                cost += 2 * least_turn
+            return cost
+
+        first = start.cell * 4 + HEADINGS.index(direction)
+        # Ties go to the state furthest along, which avoids expanding every
+        # equally good staircase
+        frontier = [(estimate(start.cell, first % 4), 0, first)]
+        came_from = {first: -1}
+        cost_so_far = {first: 0}
+        found = None
+
+        while frontier:
+            priority, _, current = heappop(frontier)
+            cell, heading = divmod(current, 4)
+            if cell == goal:
+                found = current
+                break
+            cost = cost_so_far[current]
+            if priority > cost + estimate(cell, heading):
+                continue
+
+            for new_heading in range(4):
+                next_cell = cell + steps[new_heading]
+                if not cells[next_cell]:
+                    continue
+                next = next_cell * 4 + new_heading
+                new_cost = cost + turn_costs[(new_heading - heading) % 4] + move
+                if next not in cost_so_far or new_cost < cost_so_far[next]:
+                    cost_so_far[next] = new_cost
+                    came_from[next] = current
+                    priority = new_cost + estimate(next_cell, new_heading)
+                    heappush(frontier, (priority, -new_cost, next))
+
+        if found is None:
+            raise KeyError(goal)
+        path = [found // 4]
+        while came_from[found] != -1:
+            found = came_from[found]
+            path.append(found // 4)
+        path.reverse()
+
+        return [Node(self, cell) for cell in path]
+
+    def costs_from(
+        self, start: int, targets: list[int], direction: str = None, costs: tuple = None
+    ) -> dict[int, float]:
+        # Cost from start to every target cell in one search that ends once
+        # the last of them is settled, INF for the ones it cannot reach.
+        # Without costs the cost is in cells, with them it is in seconds
+        # over (cell, heading) states as in build_timed_path, starting
+        # facing direction or, when None, whichever way is cheapest.
+        remaining = set(targets)
+        found = {target: INF for target in remaining}
+        cells = self.cells
+        if costs is None:
+            frontier = [start]
+            seen = {start}
+            distance = 0
+            while frontier and remaining:
+                next_frontier = []
+                for cell in frontier:
+                    if cell in remaining:
+                        found[cell] = distance
+                        remaining.discard(cell)
+                    for next in self.neighbours(cell):
+                        if next not in seen:
+                            seen.add(next)
+                            next_frontier.append(next)
+                frontier = next_frontier
+                distance += 1
+            return found
+
+        move, right, left = costs
+        steps = [-self.wid, 1, self.wid, -1]
+        # Cost of a step to each new heading from each old one
+        step_costs = [
+            [[0, right, 2 * right, left][(new - old) % 4] + move for new in range(4)]
+            for old in range(4)
+        ]
+        headings = range(4) if direction is None else [HEADINGS.index(direction)]
+        frontier = [(0, start * 4 + heading) for heading in headings]
+        cost_so_far = [INF] * (len(cells) * 4)
+        for _, state in frontier:
+            cost_so_far[state] = 0
+        while frontier and remaining:
+            cost, current = heappop(frontier)
+            if cost > cost_so_far[current]:
+                continue
+            cell = current >> 2
+            if cell in remaining:
+                found[cell] = cost
+                remaining.discard(cell)
+            turn = step_costs[current & 3]
+            for new_heading in range(4):
+                next_cell = cell + steps[new_heading]
+                if cells[next_cell]:
+                    next = next_cell * 4 + new_heading
+                    new_cost = cost + turn[new_heading]
+                    if new_cost < cost_so_far[next]:
+                        cost_so_far[next] = new_cost
+                        heappush(frontier, (new_cost, next))
+        return found
 
     def heuristic(self, node_1: Node, node_2: Node):
+        return self.distance(node_1.cell, node_2.cell)
+
+    def distance(self, cell_1: int, cell_2: int) -> int:
         # Manhattan distance on a square grid
-        return abs(node_1.id // self.wid - node_2.id // self.wid) + abs(
-            node_1.id % self.wid - node_2.id % self.wid
+        return abs(cell_1 // self.wid - cell_2 // self.wid) + abs(
+            cell_1 % self.wid - cell_2 % self.wid
         )
 
+    def landmark_distance(self, cell_1: int, cell_2: int) -> int:
+        # Lower bound from the triangle inequality over every landmark
+        best = self.distance(cell_1, cell_2)
+        for table in self.landmarks:
+            distance_1 = table[cell_1]
+            distance_2 = table[cell_2]
+            if distance_1 >= 0 and distance_2 >= 0:
+                best = max(best, abs(distance_1 - distance_2))
+        return best
+
+    def cast_ray(self, x: float, y: float, angle: float, max_range: float):
+        # Walks the cells crossed by a ray from (x, y), in cell units with
+        # x along columns and y along rows, at angle degrees clockwise from
+        # north. Returns the distance to the first blocked cell (or
+        # max_range), the free cells passed and the blocked cell hit.
+        dx = math.sin(math.radians(angle))
+        dy = -math.cos(math.radians(angle))
+        col, row = int(x), int(y)
+        step_col = 1 if dx > 0 else -1
+        step_row = 1 if dy > 0 else -1
+        delta_col = abs(1 / dx) if abs(dx) > 1e-9 else INF
+        delta_row = abs(1 / dy) if abs(dy) > 1e-9 else INF
+        next_col = (col + (dx > 0) - x) / dx if delta_col != INF else INF
+        next_row = (row + (dy > 0) - y) / dy if delta_row != INF else INF
+
+        passed = []
+        while True:
+            if next_col < next_row:
+                distance = next_col
+                next_col += delta_col
+                col += step_col
+            else:
+                distance = next_row
+                next_row += delta_row
+                row += step_row
+            if distance > max_range:
+                return max_range, passed, None
+            if not (0 <= row < self.len and 0 <= col < self.wid):
+                return distance, passed, None
+            cell = row * self.wid + col
+            if not self.cells[cell]:
+                return distance, passed, cell
+            passed.append(cell)
+
     def create_command_sequence(
         self, path: list[Node], initial_direction: str
     ) -> list[str]:
         direction = initial_direction
         result = []
         for node, next_node in zip(path[:-1], path[1:]):
-            if next_node.id == node.id + 1:
+            if next_node.cell == node.cell + 1:
                 if direction == "N":
                     result.extend(["rgt", "fwd"])
                 elif direction == "S":
@@ -156,7 +448,7 @@ class Graph:
                     result.append("fwd")
                 direction = "E"
 
-            elif next_node.id == node.id - 1:
+            elif next_node.cell == node.cell - 1:
                 if direction == "N":
                     result.extend(["lft", "fwd"])
                 elif direction == "S":
@@ -167,7 +459,7 @@ class Graph:
                     result.extend(["rgt", "rgt", "fwd"])
                 direction = "W"
 
-            elif next_node.id == node.id + self.wid:
+            elif next_node.cell == node.cell + self.wid:
                 if direction == "N":
                     result.extend(["rgt", "rgt", "fwd"])
                 elif direction == "S":
@@ -178,7 +470,7 @@ class Graph:
                     result.extend(["rgt", "fwd"])
                 direction = "S"
 
-            elif next_node.id == node.id - self.wid:
+            elif next_node.cell == node.cell - self.wid:
                 if direction == "N":
                     result.append("fwd")
                 elif direction == "S":
@@ -191,6 +483,158 @@ class Graph:
 
         return result
 
+    def create_motion_plan(
+        self, path: list[Node], initial_direction: str
+    ) -> list[tuple[str, int]]:
+        # Run-length form of the command sequence: ("fwd", cells) for a
+        # straight run and ("turn", degrees) with right turns positive
+        plan = []
+        for cmd in self.create_command_sequence(path, initial_direction):
+            kind, amount = ("fwd", 1) if cmd == "fwd" else ("turn", TURNS[cmd])
+            if plan and plan[-1][0] == kind:
+                amount += plan.pop()[1]
+            plan.append((kind, amount))
+        return plan
+
+
+def dilate(blocked: bytes, length: int, width: int, radius: int) -> bytes:
+    # Grows every obstacle to a disc of radius cells, radius 1 being the
+    # 4 neighbours Graph uses. The grid is handled as one big integer with
+    # a bit per cell, so the work is a few shifts per row offset of the disc
+    # no matter how many obstacles there are. Returns 1 for free cells.
+    size = length * width
+    bits = int(bytes(blocked).translate(TO_BITS)[::-1], 2)
+    full = (1 << size) - 1
+    # 1 in the first column of every row
+    rows = full // ((1 << width) - 1)
+
+    # spread[w] has every obstacle spread w cells left and right. A column
+    # mask keeps a shift from wrapping into the neighbouring row.
+    spread = [bits]
+    for shift in range(1, min(radius, width - 1) + 1):
+        to_right = ((1 << width) - (1 << shift)) * rows
+        to_left = ((1 << (width - shift)) - 1) * rows
+        spread.append(
+            spread[-1] | ((bits << shift) & to_right) | ((bits >> shift) & to_left)
+        )
+
+    grown = 0
+    for row in range(-radius, radius + 1):
+        part = spread[min(math.isqrt(radius * radius - row * row), len(spread) - 1)]
+        if row > 0:
+            grown |= part << (row * width)
+        else:
+            grown |= part >> (-row * width)
+    grown &= full
+
+    return format(grown, "0%db" % size)[::-1].encode("ascii").translate(FROM_BITS)
+
+
+class DStarLite:
+    # D* Lite (Koenig & Likhachev) searching from the goal back to the robot.
+    # g and rhs survive between plan() calls, so after update() only the
+    # cells whose distance to the goal changed are expanded again.
+    def __init__(self, graph: Graph, goal: int):
+        self.graph = graph
+        self.goal = goal
+        self.start = None
+        self.km = 0
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.open = {}
+        self.queue = []
+
+    def key(self, cell: int) -> tuple:
+        value = min(self.g.get(cell, INF), self.rhs.get(cell, INF))
+        return (value + self.graph.distance(self.start, cell) + self.km, value)
+
+    def push(self, cell: int):
+        key = self.key(cell)
+        self.open[cell] = key
+        heappush(self.queue, (key, cell))
+
+    def update_vertex(self, cell: int):
+        if not self.graph.cells[cell]:
+            self.rhs[cell] = INF
+        elif cell != self.goal:
+            self.rhs[cell] = min(
+                (self.g.get(next, INF) + 1 for next in self.graph.neighbours(cell)),
+                default=INF,
+            )
+        self.open.pop(cell, None)
+        if self.g.get(cell, INF) != self.rhs.get(cell, INF):
+            self.push(cell)
+
+    def compute(self):
+        while self.queue:
+            key, cell = self.queue[0]
+            if self.open.get(cell) != key:
+                # Stale entry left behind by a later push
+                heappop(self.queue)
+                continue
+            if key >= self.key(self.start) and self.rhs.get(
+                self.start, INF
+            ) == self.g.get(self.start, INF):
+                break
+            heappop(self.queue)
+            del self.open[cell]
+            if key < self.key(cell):
+                self.push(cell)
+            elif self.g.get(cell, INF) > self.rhs[cell]:
+                self.g[cell] = self.rhs[cell]
+                for next in self.graph.neighbours(cell):
+                    self.update_vertex(next)
+            else:
+                self.g[cell] = INF
+                self.update_vertex(cell)
+                for next in self.graph.neighbours(cell):
+                    self.update_vertex(next)
+
+    def update(self, cells: list[int]):
+        for cell in cells:
+            self.update_vertex(cell)
+            for next in self.graph.neighbours(cell):
+                self.update_vertex(next)
+
+    def cut_off(self, start: int) -> bool:
+        # Bounded search from the robot. True when it runs out of cells
+        # before meeting the goal, compute() would otherwise expand all of
+        # the goal's side of the map before giving up.
+        seen = {start}
+        frontier = [start]
+        while frontier and len(seen) < REACH_CHECK:
+            cell = frontier.pop()
+            for next in self.graph.neighbours(cell):
+                if next == self.goal:
+                    return False
+                if next not in seen:
+                    seen.add(next)
+                    frontier.append(next)
+        return not frontier
+
+    def plan(self, start: int) -> list[int]:
+        if start != self.goal and self.cut_off(start):
+            raise KeyError(self.goal)
+        if self.start is None:
+            self.start = start
+            self.push(self.goal)
+        elif start != self.start:
+            self.km += self.graph.distance(self.start, start)
+            self.start = start
+        self.compute()
+
+        if self.g.get(start, INF) == INF:
+            raise KeyError(self.goal)
+        path = [start]
+        while path[-1] != self.goal:
+            path.append(
+                min(
+                    self.graph.neighbours(path[-1]),
+                    key=lambda next: self.g.get(next, INF),
+                )
+            )
+        return path
+
 
 if __name__ == "__main__":
     graph = Graph(12, 15, [])
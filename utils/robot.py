@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import math
+import time
+
+from utils.metrics import timed
+
+MOVEMENT_ITERATIONS = 5
+MINIMAL_DISTANCE = 15
+RANGEFINDER_DELTA = 1.5
+# Seconds a calibration turn may take to come back round to the wall
+CALIBRATION_TURN_TIMEOUT = 15.0
+# Calibration used until RobotState.calibrate runs
+MOVE_FWD_TIME = 0.448
+TURN_RGT_TIME = 0.3293
+TURN_LFT_TIME = 0.4621
+# One grid cell is the distance covered in move_fwd_time, in cm
+CELL_SIZE = 10.0
+# Mounting angle of each rangefinder, clockwise from the robot heading
+RANGE_ANGLES = {"left_60": -60, "left_30": -30, "fwd": 0, "rgt_30": 30, "rgt_60": 60}
+# Compass headings in degrees, clockwise from north
+HEADINGS = {"N": 0, "E": 90, "S": 180, "W": 270}
+
+
+class RobotState:
+    def __init__(self):
+        self.direction = "N"
+        self.position = None
+        self.move_fwd_time = 0.0
+        self.turn_rgt_time = 0.0
+        self.turn_lft_time = 0.0
+        # Anything with sleep() and time(), a simulator can pass its own
+        self.clock = time
+
+    def change_dir_lft(self):
+        if self.direction == "N":
+            self.direction = "W"
+        elif self.direction == "W":
+            self.direction = "S"
+        elif self.direction == "S":
+            self.direction = "E"
+        elif self.direction == "E":
+            self.direction = "N"
+
+    def change_dir_rgt(self):
+        if self.direction == "N":
+            self.direction = "E"
+        elif self.direction == "E":
+            self.direction = "S"
+        elif self.direction == "S":
+            self.direction = "W"
+        elif self.direction == "W":
+            self.direction = "N"
+
+    def calibrate(self, conn, rangefinders, wait=None):
+        # Raises ValueError on a missed echo and then keeps the old timings,
+        # a single inf reading would otherwise end up saved as 0.0 or nan.
+        # Every pause goes through wait(seconds), which the executor uses
+        # to end a cancelled calibration.
+        sleep = self.clock.sleep if wait is None else wait
+
+        def measure() -> float:
+            distance = rangefinders["fwd"].get_distance()
+            if not math.isfinite(distance):
+                raise ValueError("Calibration needs a wall in front of fwd")
+            return distance
+
+        start = measure()
+        print(start)
+        self.prepare(conn, sleep)
+        # Moving forward
+        send_cmd(conn, b"FWD\n")
+        sleep(2)
+        send_cmd(conn, b"STP\n")
+        finish = measure()
+        print(finish)
+        if finish == start:
+            raise ValueError("Calibration did not see the robot move")
+        move_fwd_time = round(20.0 / abs(finish - start), 4)
+        print(move_fwd_time)
+        # Returning back
+        send_cmd(conn, b"BCK\n")
+        sleep(2)
+        send_cmd(conn, b"STP\n")
+        sleep(2)
+
+        start = measure()
+        distance = 0.0
+        # Turning right
+        start_time = self.clock.time()
+        send_cmd(conn, b"RGT\n")
+        sleep(1)
+        while distance > (start + RANGEFINDER_DELTA) or distance < (
+            start - RANGEFINDER_DELTA
+        ):
+            if self.clock.time() - start_time > CALIBRATION_TURN_TIMEOUT:
+                send_cmd(conn, b"STP\n")
+                raise ValueError("Calibration turn never came back to the wall")
+            distance = rangefinders["fwd"].get_distance()
+            sleep(0.01)
+        stop_time = self.clock.time()
+        # Divide the time of 360 turn by 12 to get 30 turn
+        turn_rgt_time = round((stop_time - start_time) / 12, 4)
+        send_cmd(conn, b"STP\n")
+
+        sleep(2)
+
+        start = measure()
+        distance = 0.0
+        # Turning left
+        start_time = self.clock.time()
+        send_cmd(conn, b"LFT\n")
+        sleep(1)
+        while distance > (start + RANGEFINDER_DELTA) or distance < (
+            start - RANGEFINDER_DELTA
+        ):
+            if self.clock.time() - start_time > CALIBRATION_TURN_TIMEOUT:
+                send_cmd(conn, b"STP\n")
+                raise ValueError("Calibration turn never came back to the wall")
+            distance = rangefinders["fwd"].get_distance()
+            sleep(0.01)
+        stop_time = self.clock.time()
+        # Divide the time of 360 turn by 12 to get 30 turn
+        turn_lft_time = round((stop_time - start_time) / 12, 4)
+        send_cmd(conn, b"STP\n")
+
+        self.move_fwd_time = move_fwd_time
+        self.turn_rgt_time = turn_rgt_time
+        self.turn_lft_time = turn_lft_time
+        return
+
+    def prepare(self, conn, wait=None):
+        # wait(seconds) as in calibrate, so that a cancel is not held up
+        sleep = self.clock.sleep if wait is None else wait
+        sleep(1)
+        send_cmd(conn, b"FWD\n")
+        sleep(0.1)
+        send_cmd(conn, b"BCK\n")
+        sleep(0.1)
+        send_cmd(conn, b"STP\n")
+
+    def step_costs(self) -> tuple:
+        # Seconds of one fwd, rgt and lft command of a trip
+        return (self.move_fwd_time, 3 * self.turn_rgt_time, 3 * self.turn_lft_time)
+
+    def to_dict(self) -> dict:
+        return {
+            "direction": self.direction,
+            "position": self.position.id if self.position else None,
+            "move_fwd_time": self.move_fwd_time,
+            "turn_rgt_time": self.turn_rgt_time,
+            "turn_lft_time": self.turn_lft_time,
+        }
+
+    def print_state(self):
+        print(
+            {
+                "Direction": self.direction,
+                "Position": self.position,
+                "Move Forward Time": self.move_fwd_time,
+                "Turn Right Time": self.turn_rgt_time,
+                "Turn Left Time": self.turn_lft_time,
+            }
+        )
+
+
+@timed("send_cmd_seconds", "Time of writing one motor command")
+def send_cmd(conn, cmd: str):
+    conn.write(cmd)
+    return
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+from collections import OrderedDict, deque
+
+from utils.pathing import Graph, Node
+
+ROUTE_CACHE_SIZE = 4096
+# Turn times are keyed in steps of this many move times, see RouteCache.key
+COST_STEP = 0.1
+# Distance in landmark tables for cells the landmark cannot reach
+UNREACHABLE = -1
+
+
+class RouteCache:
+    # Memoized build_path. Routes are kept as cell lists keyed by
+    # (start, dest, heading, turn costs) and evicted least recently used first.
+    # The graph only ever gains obstacles, so a cached route that does not
+    # cross a newly blocked cell is still optimal and only the routes that
+    # do are dropped.
+    def __init__(self, graph: Graph, size: int = ROUTE_CACHE_SIZE):
+        self.graph = graph
+        self.size = size
+        self.routes = OrderedDict()
+        # cell -> keys of the cached routes through it
+        self.through = {}
+        self.hits = 0
+        self.misses = 0
+        graph.listeners.append(self.on_change)
+
+    def key(self, start: int, dest: int, direction: str, costs: tuple) -> tuple:
+        # The heading only changes the route when turns have a cost
+        if costs is None:
+            return (start, dest)
+        # A route only depends on how the turns compare with a move. Online
+        # calibration nudges the timings after almost every trip, so the
+        # key has the turn to move ratios in COST_STEP steps, not the exact
+        # seconds, or repeat routes would never hit.
+        move, right, left = costs
+        return (
+            start,
+            dest,
+            direction,
+            round(right / move / COST_STEP),
+            round(left / move / COST_STEP),
+        )
+
+    def build_path(
+        self, start: Node, dest: Node, direction: str = None, costs: tuple = None
+    ) -> list[Node]:
+        key = self.key(start.cell, dest.cell, direction, costs)
+        cells = self.routes.get(key)
+        if cells is not None:
+            self.hits += 1
+            self.routes.move_to_end(key)
+        else:
+            self.misses += 1
+            path = self.graph.build_path(start, dest, direction, costs)
+            cells = [node.cell for node in path]
+            self.store(key, cells)
+        # Callers consume the path as they drive, so hand out a fresh list
+        return [Node(self.graph, cell) for cell in cells]
+
+    def store(self, key: tuple, cells: list[int]):
+        if key in self.routes:
+            self.forget(key)
+        self.routes[key] = cells
+        for cell in cells:
+            self.through.setdefault(cell, set()).add(key)
+        while len(self.routes) > self.size:
+            self.forget(next(iter(self.routes)))
+
+    def forget(self, key: tuple):
+        for cell in self.routes.pop(key):
+            keys = self.through.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.through[cell]
+
+    def on_change(self, cells: list[int]):
+        for cell in cells:
+            for key in list(self.through.get(cell, ())):
+                self.forget(key)
+
+    def clear(self):
+        self.routes.clear()
+        self.through.clear()
+
+    def precompute(self, cells: list[int] = None):
+        # Fills the cache with the shortest routes between every pair of
+        # cells, one breadth first search per source. Meant for the small
+        # set of docking and pick cells, or for every cell of a small map.
+        graph = self.graph
+        if cells is None:
+            cells = [cell for cell in range(len(graph.cells)) if graph.cells[cell]]
+        targets = set(cells)
+        for source in cells:
+            came_from = search(graph, source)[1]
+            for dest in targets:
+                if dest == source or dest not in came_from:
+                    continue
+                route = [dest]
+                while route[-1] != source:
+                    route.append(came_from[route[-1]])
+                route.reverse()
+                self.store(self.key(source, dest, None, None), route)
+
+    def build_landmarks(self, count: int):
+        # ALT tables for the A* of graph.build_path: exact distances from a
+        # few landmarks spread out by farthest point selection. Obstacles
+        # marked later only make true distances longer, so the tables stay
+        # admissible; call this again to tighten them.
+        graph = self.graph
+        free = [cell for cell in range(len(graph.cells)) if graph.cells[cell]]
+        graph.landmarks = []
+        if not free or count <= 0:
+            return
+        landmark = free[0]
+        nearest = None
+        for _ in range(count):
+            table = search(graph, landmark)[0]
+            graph.landmarks.append(table)
+            if nearest is None:
+                nearest = list(table)
+            else:
+                nearest = [
+                    distance if distance < old or old == UNREACHABLE else old
+                    for distance, old in zip(table, nearest)
+                ]
+            landmark = max(free, key=lambda cell: nearest[cell])
+            if nearest[landmark] <= 0:
+                break
+
+
+def search(graph: Graph, source: int) -> tuple[list[int], dict]:
+    # Breadth first search over free cells, distances and parents
+    distances = [UNREACHABLE] * len(graph.cells)
+    distances[source] = 0
+    came_from = {source: -1}
+    frontier = deque([source])
+    while frontier:
+        current = frontier.popleft()
+        for next in graph.neighbours(current):
+            if distances[next] == UNREACHABLE:
+                distances[next] = distances[current] + 1
+                came_from[next] = current
+                frontier.append(next)
+    return distances, came_from
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+from collections import deque
+
+# Oldest reading the control loop accepts before waiting for a new one
+MAX_AGE = 0.1
+# Longest a stale read waits for the sampler before giving up
+SAMPLE_TIMEOUT = 0.5
+HISTORY_SIZE = 64
+
+
+class CachedRangefinder:
+    # Stands in for a Rangefinder, but answers from the sampler cache
+    def __init__(self, sampler, name: str):
+        self.sampler = sampler
+        self.name = name
+
+    def get_distance(self) -> float:
+        return self.sampler.get_distances([self.name])[self.name]
+
+
+class SensorSampler(threading.Thread):
+    def __init__(
+        self,
+        array,
+        period: float = 0.01,
+        max_age: float = MAX_AGE,
+        filters: dict = None,
+    ):
+        super().__init__(daemon=True)
+        self.array = array
+        # Optional per-sensor RangeFilter applied to every sample
+        self.filters = filters or {}
+        self.period = period
+        self.max_age = max_age
+        # Ring buffer of (timestamp, readings), newest last
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.latest = None
+        self.updated = threading.Condition()
+        self.stopped = threading.Event()
+        self.rangefinders = {
+            name: CachedRangefinder(self, name) for name in array.rangefinders
+        }
+
+    def run(self):
+        while not self.stopped.is_set():
+            readings = self.array.get_distances()
+            for name, filter in self.filters.items():
+                readings[name] = filter.update(readings[name])
+            sample = (time.monotonic(), readings)
+            # Appending to a deque and rebinding an attribute are atomic,
+            # so readers never need the lock
+            self.history.append(sample)
+            self.latest = sample
+            with self.updated:
+                self.updated.notify_all()
+            self.stopped.wait(self.period)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def get_distances(
+        self, names: list[str] = None, max_age: float = None
+    ) -> dict[str, float]:
+        if max_age is None:
+            max_age = self.max_age
+        sample = self.latest
+        if sample is None or time.monotonic() - sample[0] > max_age:
+            # Only wait when the cache has gone stale
+            with self.updated:
+                self.updated.wait_for(
+                    lambda: self.latest is not None
+                    and time.monotonic() - self.latest[0] <= max_age,
+                    timeout=SAMPLE_TIMEOUT,
+                )
+            sample = self.latest
+            if sample is None or time.monotonic() - sample[0] > max_age:
+                raise TimeoutError("No fresh rangefinder readings")
+        readings = sample[1]
+        if names is None:
+            return dict(readings)
+        return {name: readings[name] for name in names}
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import time
+
+from utils.calibration import OnlineCalibrator
+from utils.executor import Job, MotionExecutor
+from utils.occupancy import OccupancyGrid
+from utils.odometry import RangeOdometry
+from utils.pathing import Graph
+from utils.robot import (
+    CELL_SIZE,
+    HEADINGS,
+    MOVE_FWD_TIME,
+    RANGE_ANGLES,
+    TURN_LFT_TIME,
+    TURN_RGT_TIME,
+    RobotState,
+)
+from utils.routecache import search
+from utils.trace import TracedConnection, TracedSensors, TraceRecorder
+
+# Farthest distance the rangefinders report, in cm
+MAX_RANGE = 400.0
+NO_ECHO = float("inf")
+
+
+class SimWorld:
+    # Ground truth of the simulation: the real obstacle map and the
+    # continuous pose of the robot, in cell units
+    def __init__(
+        self,
+        graph: Graph,
+        move_fwd_time: float,
+        turn_rgt_time: float,
+        turn_lft_time: float,
+        cell_size: float = CELL_SIZE,
+        noise: float = 0.0,
+        seed: int = None,
+    ):
+        self.graph = graph
+        self.speed = 1.0 / move_fwd_time
+        # One turn_*_time turns the robot by 30 degrees
+        self.turn_rates = {b"RGT": 30.0 / turn_rgt_time, b"LFT": -30.0 / turn_lft_time}
+        self.cell_size = cell_size
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.now = 0.0
+        self.motion = b"STP"
+        self.stop_at = None
+        self.factor = 1.0
+        self.bumped = False
+        self.collisions = 0
+
+    def place(self, cell: int, direction: str):
+        row, col = divmod(cell, self.graph.wid)
+        self.x = col + 0.5
+        self.y = row + 0.5
+        self.heading = HEADINGS[direction]
+
+    def cell(self) -> int:
+        return int(self.y) * self.graph.wid + int(self.x)
+
+    def command(self, cmd: bytes, duration: float = None):
+        self.motion = cmd
+        self.stop_at = self.now + duration if duration is not None else None
+        self.factor = 1.0 + self.random.gauss(0, self.noise) if self.noise else 1.0
+        self.bumped = False
+
+    def advance(self, dt: float):
+        while dt > 1e-12:
+            step = dt
+            if self.stop_at is not None:
+                step = min(step, max(0.0, self.stop_at - self.now))
+            self.move(step)
+            self.now += step
+            dt -= step
+            if self.stop_at is not None and self.now >= self.stop_at:
+                self.motion = b"STP"
+                self.stop_at = None
+        # A remainder too small to move still has to pass, or a wait that
+        # is that close to its deadline never gets there
+        self.now += dt
+
+    def move(self, dt: float):
+        if self.motion in self.turn_rates:
+            self.heading = (
+                self.heading + self.turn_rates[self.motion] * self.factor * dt
+            ) % 360
+        elif self.motion in [b"FWD", b"BCK"]:
+            angle = self.heading if self.motion == b"FWD" else self.heading + 180
+            wanted = self.speed * self.factor * dt
+            free, _, _ = self.graph.cast_ray(self.x, self.y, angle, wanted)
+            if free < wanted:
+                # Keep clear of the wall and count one collision per push
+                if not self.bumped:
+                    self.collisions += 1
+                self.bumped = True
+                free = max(0.0, free - 1e-6)
+            self.x += math.sin(math.radians(angle)) * free
+            self.y -= math.cos(math.radians(angle)) * free
+
+    def distance(self, angle: float) -> float:
+        limit = MAX_RANGE / self.cell_size
+        distance, _, _ = self.graph.cast_ray(
+            self.x, self.y, self.heading + angle, limit
+        )
+        if distance >= limit:
+            return NO_ECHO
+        distance *= self.cell_size
+        if self.noise:
+            distance *= 1.0 + self.random.gauss(0, self.noise)
+        return distance
+
+
+class SimClock:
+    # Clock for the executor and RobotState. Sleeping advances the world;
+    # without realtime no wall-clock time passes at all.
+    def __init__(self, world: SimWorld, realtime: bool = False):
+        self.world = world
+        self.realtime = realtime
+
+    def monotonic(self) -> float:
+        return self.world.now
+
+    def time(self) -> float:
+        return self.world.now
+
+    def sleep(self, duration: float):
+        if self.realtime:
+            time.sleep(duration)
+        self.world.advance(duration)
+
+
+class SimSerial:
+    # Answers FWD/BCK/LFT/RGT/STP like the motor firmware
+    def __init__(self, world: SimWorld, acknowledged: bool = False):
+        self.world = world
+        self.acknowledged = acknowledged
+
+    def write(self, cmd: bytes):
+        self.world.command(cmd.split()[0])
+
+    def send(self, cmd: bytes, duration: float = None) -> int:
+        self.world.command(cmd.strip(), duration)
+        return 0
+
+    def flush(self):
+        pass
+
+    def readline(self) -> bytes:
+        return b""
+
+
+class SimRangefinder:
+    def __init__(self, world: SimWorld, angle: float):
+        self.world = world
+        self.angle = angle
+
+    def get_distance(self) -> float:
+        return self.world.distance(self.angle)
+
+
+class SimSensors:
+    # Same interface as SensorSampler, every read is a fresh ray cast
+    def __init__(self, world: SimWorld):
+        self.world = world
+        self.rangefinders = {
+            name: SimRangefinder(world, angle) for name, angle in RANGE_ANGLES.items()
+        }
+
+    @property
+    def latest(self) -> tuple:
+        return (self.world.now, self.get_distances())
+
+    def get_distances(self, names: list[str] = None, max_age: float = None) -> dict:
+        if names is None:
+            names = list(self.rangefinders)
+        return {name: self.rangefinders[name].get_distance() for name in names}
+
+
+def random_world(
+    length: int, width: int, density: float, rng: random.Random
+) -> Graph:
+    inner = [
+        i * width + j for i in range(1, length - 1) for j in range(1, width - 1)
+    ]
+    # Graph inflates every obstacle by its 4 neighbours
+    obstacles = rng.sample(inner, int(len(inner) * density / 5))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return Graph(length, width, obstacles)
+
+
+def run_trips(
+    trips: int,
+    length: int = 12,
+    width: int = 15,
+    density: float = 0.05,
+    noise: float = 0.0,
+    cell_size: float = CELL_SIZE,
+    seed: int = 0,
+    min_time: bool = False,
+    occupancy: bool = False,
+    closed_loop: bool = False,
+    online_calibration: bool = False,
+    timing_error: float = 0.0,
+    trace: str = None,
+    tour: int = 0,
+) -> dict:
+    rng = random.Random(seed)
+    truth = random_world(length, width, density, rng)
+    free = [cell for cell in range(length * width) if truth.cells[cell]]
+
+    # The robot starts off by timing_error, the world runs the true times
+    robot = RobotState()
+    robot.move_fwd_time = MOVE_FWD_TIME * (1 + timing_error)
+    robot.turn_rgt_time = TURN_RGT_TIME * (1 + timing_error)
+    robot.turn_lft_time = TURN_LFT_TIME * (1 + timing_error)
+    robot.direction = "S"
+
+    world = SimWorld(
+        truth,
+        MOVE_FWD_TIME,
+        TURN_RGT_TIME,
+        TURN_LFT_TIME,
+        cell_size=cell_size,
+        noise=noise,
+        seed=seed,
+    )
+    clock = SimClock(world)
+    robot.clock = clock
+
+    stats = {
+        "trips": trips,
+        "finished": 0,
+        "arrived": 0,
+        "replans": 0,
+        "replaced": 0,
+    }
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # The planner starts without knowing any obstacle
+        graph = Graph(length, width, [], incremental=not min_time)
+        conn = SimSerial(world)
+        sensors = SimSensors(world)
+        recorder = None
+        if trace:
+            recorder = TraceRecorder(trace, clock)
+            recorder.config(
+                min_time=min_time,
+                occupancy=occupancy,
+                closed_loop=closed_loop,
+                online_calibration=online_calibration,
+                cell_size=cell_size,
+                incremental=not min_time,
+            )
+            recorder.snapshot(graph)
+            graph.listeners.append(recorder.on_change)
+            conn = TracedConnection(conn, recorder)
+            sensors = TracedSensors(sensors, recorder)
+        executor = MotionExecutor(
+            conn,
+            robot,
+            graph,
+            sensors,
+            clock,
+            min_time=min_time,
+            occupancy=OccupancyGrid(graph, cell_size) if occupancy else None,
+            odometry=RangeOdometry(graph, cell_size) if closed_loop else None,
+            calibrator=(
+                OnlineCalibrator(robot, cell_size=cell_size)
+                if online_calibration
+                else None
+            ),
+            trace=recorder,
+        )
+        free_cells = set(free)
+
+        def destinations(cell: int) -> list[int]:
+            # Free cells the planner can still reach from cell
+            came_from = search(graph, cell)[1]
+            return sorted(
+                next for next in came_from if next != cell and next in free_cells
+            )
+
+        robot.position = graph.get_node_by_id(rng.choice(free))
+        for trip in range(trips):
+            reachable = destinations(robot.position.cell)
+            if not graph.cells[robot.position.cell] or len(reachable) < max(tour, 1):
+                # Stranded in a cell the planner has given up on or walled in
+                # by marks, a trip from here could only fail in planning
+                candidates = [cell for cell in free if graph.cells[cell]]
+                rng.shuffle(candidates)
+                for cell in candidates:
+                    reachable = destinations(cell)
+                    if len(reachable) >= max(tour, 1):
+                        robot.position = graph.get_node_by_id(cell)
+                        stats["replaced"] += 1
+                        break
+                else:
+                    # Nowhere left on the map to go
+                    break
+            world.place(robot.position.cell, robot.direction)
+            if tour:
+                # Each trip visits tour stops in the order the executor picks
+                stops = rng.sample(reachable, tour)
+                nodes = [graph.get_node_by_id(stop) for stop in stops]
+                job = Job(trip + 1, "tour", None, nodes)
+            else:
+                destination = rng.choice(reachable)
+                job = Job(trip + 1, "move", graph.get_node_by_id(destination))
+            executor.execute(job)
+            stats["replans"] += job.replans
+            if job.status == "finished":
+                stats["finished"] += 1
+                if job.destination is None or world.cell() == job.destination.cell:
+                    stats["arrived"] += 1
+        if recorder is not None:
+            recorder.close()
+    elapsed = time.perf_counter() - started
+
+    stats["collisions"] = world.collisions
+    if online_calibration:
+        stats["timings"] = [round(value, 4) for value in robot.step_costs()]
+    stats["sim_seconds"] = round(world.now, 3)
+    stats["wall_seconds"] = round(elapsed, 3)
+    # Failed trips end early and would only make the run look faster
+    stats["trips_per_minute"] = round(stats["finished"] / elapsed * 60, 1)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run simulated robot trips")
+    parser.add_argument("--trips", type=int, default=1000)
+    parser.add_argument("--size", default="12x15", help="map LENGTHxWIDTH")
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--noise", type=float, default=0.0)
+    parser.add_argument("--cell-size", type=float, default=CELL_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--min-time", action="store_true", help="plan the quickest routes"
+    )
+    parser.add_argument(
+        "--occupancy", action="store_true", help="map obstacles from every reading"
+    )
+    parser.add_argument(
+        "--closed-loop", action="store_true", help="end runs on range to known walls"
+    )
+    parser.add_argument(
+        "--online-calibration", action="store_true", help="refine timings on trips"
+    )
+    parser.add_argument(
+        "--timing-error", type=float, default=0.0, help="initial timing error"
+    )
+    parser.add_argument("--trace", help="record the trips to this trace file")
+    parser.add_argument(
+        "--tour", type=int, default=0, help="visit this many stops per trip"
+    )
+    args = parser.parse_args()
+
+    length, width = (int(value) for value in args.size.split("x"))
+    print(
+        json.dumps(
+            run_trips(
+                args.trips,
+                length,
+                width,
+                args.density,
+                args.noise,
+                args.cell_size,
+                args.seed,
+                args.min_time,
+                args.occupancy,
+                args.closed_loop,
+                args.online_calibration,
+                args.timing_error,
+                args.trace,
+                args.tour,
+            ),
+            indent=2,
+        )
+    )
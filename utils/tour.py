@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+from utils.metrics import timed
+from utils.pathing import INF, Graph
+
+# Passes of 2-opt over the tour before settling for what it has
+TWO_OPT_PASSES = 20
+
+
+def cost_matrix(
+    graph: Graph, start: int, stops: list[int], direction: str, costs: tuple
+) -> list[list[float]]:
+    # Row and column 0 are the start, the stops follow in order. One
+    # multi-target search per source instead of one path per pair; only
+    # the robot knows its heading at the start, after a stop it can leave
+    # whichever way is cheapest.
+    cells = [start] + stops
+    matrix = []
+    for index, source in enumerate(cells):
+        found = graph.costs_from(
+            source, cells, direction if index == 0 else None, costs
+        )
+        matrix.append([found[cell] for cell in cells])
+    return matrix
+
+
+def tour_cost(matrix: list[list[float]], order: list[int]) -> float:
+    return sum(matrix[a][b] for a, b in zip(order[:-1], order[1:]))
+
+
+def nearest_neighbour(matrix: list[list[float]]) -> list[int]:
+    # Open tour from 0, always on to the cheapest stop not visited yet
+    left = set(range(1, len(matrix)))
+    order = [0]
+    while left:
+        costs = matrix[order[-1]]
+        order.append(min(left, key=lambda stop: (costs[stop], stop)))
+        left.discard(order[-1])
+    return order
+
+
+def two_opt(matrix: list[list[float]], order: list[int]) -> list[int]:
+    # Reverses stretches of the tour while that makes it cheaper. Costs
+    # with turns are not quite symmetric, so a reversed stretch is costed
+    # in full rather than by its two end edges.
+    order = list(order)
+    best = tour_cost(matrix, order)
+    for _ in range(TWO_OPT_PASSES):
+        improved = False
+        for i in range(1, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                candidate = order[:i] + order[i : j + 1][::-1] + order[j + 1 :]
+                cost = tour_cost(matrix, candidate)
+                if cost < best:
+                    order, best = candidate, cost
+                    improved = True
+        if not improved:
+            break
+    return order
+
+
+@timed("plan_tour_seconds", "Time of ordering the stops of one tour")
+def order_stops(
+    graph: Graph,
+    start: int,
+    stops: list[int],
+    direction: str = None,
+    costs: tuple = None,
+) -> list[int]:
+    # Visiting order for stops from start. Duplicates and the start itself
+    # are dropped; stops the robot cannot reach go last, their leg fails
+    # when it is planned.
+    stops = [stop for stop in dict.fromkeys(stops) if stop != start]
+    if len(stops) < 2:
+        return stops
+    matrix = cost_matrix(graph, start, stops, direction, costs)
+    kept = [0] + [stop for stop in range(1, len(matrix)) if matrix[0][stop] < INF]
+    unreachable = [stop for stop in range(1, len(matrix)) if matrix[0][stop] == INF]
+    matrix = [[matrix[a][b] for b in kept] for a in kept]
+    order = [kept[index] for index in two_opt(matrix, nearest_neighbour(matrix))]
+    return [stops[index - 1] for index in order[1:] + unreachable]
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import contextlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from utils.calibration import OnlineCalibrator
+from utils.executor import Job, MotionExecutor
+from utils.occupancy import OccupancyGrid
+from utils.odometry import RangeOdometry
+from utils.pathing import Graph, Node
+from utils.robot import CELL_SIZE, RANGE_ANGLES, RobotState
+from utils.routecache import RouteCache
+
+# magic, version, bytes written so far
+HEADER = struct.Struct("<4sHxxQ")
+MAGIC = b"CFST"
+VERSION = 1
+USED_OFFSET = 8
+# kind, payload size, monotonic timestamp
+RECORD = struct.Struct("<BId")
+# First size of the file, it doubles whenever the mapping is full
+CHUNK = 1 << 20
+
+CONFIG = 1
+MAP = 2
+JOB = 3
+STATUS = 4
+SENSORS = 5
+LATEST = 6
+COMMAND = 7
+PATH = 8
+OBSTACLE = 9
+KINDS = {
+    CONFIG: "config",
+    MAP: "map",
+    JOB: "job",
+    STATUS: "status",
+    SENSORS: "sensors",
+    LATEST: "latest",
+    COMMAND: "command",
+    PATH: "path",
+    OBSTACLE: "obstacle",
+}
+
+SENSOR_NAMES = list(RANGE_ANGLES)
+# id, kind, destination, position, direction and the robot timings, then
+# the cells of the stops of a tour
+JOB_RECORD = struct.Struct("<I4sii1sddd")
+
+
+def encode_readings(readings: dict, stamp: float = math.nan) -> bytes:
+    # A bit per rangefinder present, then its reading
+    mask = 0
+    values = []
+    for index, name in enumerate(SENSOR_NAMES):
+        if name in readings:
+            mask |= 1 << index
+            values.append(readings[name])
+    return struct.pack("<dB%dd" % len(values), stamp, mask, *values)
+
+
+def decode_readings(payload: bytes) -> tuple[float, dict]:
+    stamp, mask = struct.unpack_from("<dB", payload)
+    names = [name for index, name in enumerate(SENSOR_NAMES) if mask >> index & 1]
+    values = struct.unpack_from("<%dd" % len(names), payload, 9)
+    return stamp, dict(zip(names, values))
+
+
+def decode_cells(payload: bytes) -> list[int]:
+    return list(struct.unpack("<%dI" % (len(payload) // 4), payload))
+
+
+def decode(kind: int, payload: bytes):
+    if kind == CONFIG:
+        return json.loads(payload)
+    if kind == MAP:
+        length, width = struct.unpack_from("<II", payload)
+        return length, width, payload[8:]
+    if kind == JOB:
+        id, job_kind, dest, position, direction, *times = JOB_RECORD.unpack_from(
+            payload
+        )
+        return (
+            id,
+            job_kind.decode().strip("\x00"),
+            dest,
+            position,
+            direction.decode(),
+            tuple(times),
+            decode_cells(payload[JOB_RECORD.size :]),
+        )
+    if kind == STATUS:
+        return struct.unpack_from("<I", payload)[0], payload[4:].decode()
+    if kind in [SENSORS, LATEST]:
+        return decode_readings(payload)
+    if kind == COMMAND:
+        duration = struct.unpack_from("<d", payload)[0]
+        return payload[8:], None if math.isnan(duration) else duration
+    return decode_cells(payload)
+
+
+class TraceRecorder:
+    # Append-only binary log of what the robot saw and did. Records go
+    # straight into a memory mapped file and the header always holds the
+    # number of bytes written, so a trace cut short by a crash still reads.
+    def __init__(self, path: str, clock=time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.file = open(path, "w+b")
+        self.size = CHUNK
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.end = HEADER.size
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.end)
+
+    def record(self, kind: int, payload: bytes = b""):
+        size = RECORD.size + len(payload)
+        with self.lock:
+            if self.map is None:
+                return
+            if self.end + size > self.size:
+                self.grow(self.end + size)
+            start = self.end + RECORD.size
+            RECORD.pack_into(
+                self.map, self.end, kind, len(payload), self.clock.monotonic()
+            )
+            self.map[start : start + len(payload)] = payload
+            self.end += size
+            struct.pack_into("<Q", self.map, USED_OFFSET, self.end)
+
+    def grow(self, needed: int):
+        self.map.close()
+        self.size = max(needed, 2 * self.size)
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def config(self, **options):
+        self.record(CONFIG, json.dumps(options).encode("utf-8"))
+
+    def snapshot(self, graph: Graph):
+        self.record(MAP, struct.pack("<II", graph.len, graph.wid) + bytes(graph.cells))
+
+    def job(self, job: Job, robot: RobotState):
+        self.record(
+            JOB,
+            JOB_RECORD.pack(
+                job.id,
+                job.kind.encode("utf-8"),
+                job.destination.cell if job.destination else -1,
+                robot.position.cell,
+                robot.direction.encode("utf-8"),
+                robot.move_fwd_time,
+                robot.turn_rgt_time,
+                robot.turn_lft_time,
+            )
+            + struct.pack("<%dI" % len(job.stops), *(node.cell for node in job.stops)),
+        )
+
+    def status(self, job: Job):
+        self.record(STATUS, struct.pack("<I", job.id) + job.status.encode("utf-8"))
+
+    def readings(self, kind: int, readings: dict, stamp: float = math.nan):
+        self.record(kind, encode_readings(readings, stamp))
+
+    def command(self, cmd: bytes, duration: float = None):
+        duration = math.nan if duration is None else duration
+        self.record(COMMAND, struct.pack("<d", duration) + cmd)
+
+    def path(self, cells: list[int]):
+        self.record(PATH, struct.pack("<%dI" % len(cells), *cells))
+
+    def on_change(self, cells: list[int]):
+        self.record(OBSTACLE, struct.pack("<%dI" % len(cells), *cells))
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.end)
+            self.file.close()
+
+
+def read_trace(path: str):
+    # Yields (kind, timestamp, decoded payload) in the order recorded
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, used = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a trace" % path)
+    position = HEADER.size
+    while position + RECORD.size <= used:
+        kind, size, timestamp = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        yield kind, timestamp, decode(kind, data[position : position + size])
+        position += size
+
+
+class TracedConnection:
+    # Motor connection that logs every command on its way through
+    def __init__(self, conn, trace: TraceRecorder):
+        self.conn = conn
+        self.trace = trace
+
+    def write(self, cmd: bytes):
+        self.trace.command(cmd)
+        self.conn.write(cmd)
+
+    def send(self, cmd: bytes, duration: float = None) -> int:
+        self.trace.command(cmd, duration)
+        return self.conn.send(cmd, duration)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class TracedSensors:
+    # Logs every reading handed to the control logic. The web handlers keep
+    # the plain sensors, so only what steered the robot is in the trace.
+    def __init__(self, sensors, trace: TraceRecorder):
+        self.sensors = sensors
+        self.trace = trace
+        self.rangefinders = {
+            name: TracedRangefinder(self, name) for name in sensors.rangefinders
+        }
+
+    @property
+    def latest(self) -> tuple:
+        sample = self.sensors.latest
+        if sample is not None:
+            self.trace.readings(LATEST, sample[1], sample[0])
+        return sample
+
+    def get_distances(self, names: list[str] = None, max_age: float = None) -> dict:
+        if max_age is None:
+            readings = self.sensors.get_distances(names)
+        else:
+            readings = self.sensors.get_distances(names, max_age)
+        self.trace.readings(SENSORS, readings)
+        return readings
+
+
+class TracedRangefinder:
+    def __init__(self, sensors, name: str):
+        self.sensors = sensors
+        self.name = name
+
+    def get_distance(self) -> float:
+        return self.sensors.get_distances([self.name])[self.name]
+
+
+class ReplayClock:
+    # Virtual time, sleeping costs nothing
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, duration: float):
+        self.now += max(0.0, duration)
+
+
+class ReplayConnection:
+    # Takes the commands of the replayed run in place of the motors and
+    # remembers where they first differ from the recorded ones
+    def __init__(self, recorded: list, acknowledged: bool = False):
+        self.recorded = recorded
+        self.acknowledged = acknowledged
+        self.sent = 0
+        self.divergence = None
+
+    def write(self, cmd: bytes):
+        self.check(cmd, None)
+
+    def send(self, cmd: bytes, duration: float = None) -> int:
+        self.check(cmd, duration)
+        return self.sent
+
+    def check(self, cmd: bytes, duration: float):
+        expected = None
+        if self.sent < len(self.recorded):
+            expected = self.recorded[self.sent]
+        if self.divergence is None and expected != (cmd, duration):
+            self.divergence = (self.sent, expected, (cmd, duration))
+        self.sent += 1
+
+    def flush(self):
+        pass
+
+    def readline(self) -> bytes:
+        return b""
+
+
+class ReplaySensors:
+    # Answers with the recorded readings in the order they were taken. Once
+    # the replayed run asks for other rangefinders than the recorded run
+    # did, the last readings recorded by then are used instead.
+    def __init__(self, readings: list, samples: list, clock: ReplayClock):
+        self.readings = readings
+        self.times = [timestamp for timestamp, _ in readings]
+        self.samples = samples
+        self.clock = clock
+        self.next = 0
+        self.next_sample = 0
+        self.rangefinders = {
+            name: TracedRangefinder(self, name) for name in SENSOR_NAMES
+        }
+
+    @property
+    def latest(self) -> tuple:
+        if self.next_sample >= len(self.samples):
+            return None
+        timestamp, sample = self.samples[self.next_sample]
+        self.next_sample += 1
+        self.clock.now = max(self.clock.now, timestamp)
+        return sample
+
+    def get_distances(self, names: list[str] = None, max_age: float = None) -> dict:
+        if names is None:
+            names = SENSOR_NAMES
+        if self.next < len(self.readings):
+            timestamp, readings = self.readings[self.next]
+            if all(name in readings for name in names):
+                self.next += 1
+                # The recorded run spent time between readings that the
+                # replay does not
+                self.clock.now = max(self.clock.now, timestamp)
+                return {name: readings[name] for name in names}
+        found = {}
+        index = bisect.bisect_right(self.times, self.clock.now)
+        while index > 0 and len(found) < len(names):
+            index -= 1
+            readings = self.readings[index][1]
+            for name in names:
+                if name in readings:
+                    found.setdefault(name, readings[name])
+        return {name: found.get(name, float("inf")) for name in names}
+
+
+def replay(path: str, quiet: bool = True, **overrides) -> dict:
+    # Runs the recorded jobs through the executor again with nothing but
+    # the trace, as fast as the planner and the control loop go. Options
+    # in overrides replace the recorded ones, to try a change on real trips.
+    config = {}
+    snapshot = None
+    jobs = []
+    statuses = {}
+    readings = []
+    samples = []
+    commands = []
+    obstacles = 0
+    first = last = None
+    for kind, timestamp, value in read_trace(path):
+        first = timestamp if first is None else first
+        last = timestamp
+        if kind == CONFIG:
+            config.update(value)
+        elif kind == MAP:
+            snapshot = value
+        elif kind == JOB:
+            jobs.append((timestamp, value))
+        elif kind == STATUS:
+            statuses[value[0]] = value[1]
+        elif kind == SENSORS:
+            readings.append((timestamp, value[1]))
+        elif kind == LATEST:
+            samples.append((timestamp, value))
+        elif kind == COMMAND:
+            commands.append(value)
+        elif kind == OBSTACLE:
+            obstacles += len(value)
+    if snapshot is None:
+        raise ValueError("%s holds no map" % path)
+    config.update(overrides)
+    if config.get("fleet"):
+        print("Fleet trips are replayed without the coordinator")
+
+    length, width, cells = snapshot
+    graph = Graph(
+        length, width, [], config.get("incremental", False), cells=bytearray(cells)
+    )
+    marked = []
+    graph.listeners.append(marked.extend)
+    cell_size = config.get("cell_size", CELL_SIZE)
+    clock = ReplayClock(first or 0.0)
+    conn = ReplayConnection(commands, config.get("acknowledged", False))
+    robot = RobotState()
+    robot.clock = clock
+    executor = MotionExecutor(
+        conn,
+        robot,
+        graph,
+        ReplaySensors(readings, samples, clock),
+        clock,
+        min_time=config.get("min_time", False),
+        routes=RouteCache(graph) if config.get("routes") else None,
+        occupancy=(
+            OccupancyGrid(graph, cell_size, radius=config.get("radius", 1))
+            if config.get("occupancy")
+            else None
+        ),
+        odometry=RangeOdometry(graph, cell_size) if config.get("closed_loop") else None,
+        calibrator=(
+            OnlineCalibrator(robot, cell_size=cell_size)
+            if config.get("online_calibration")
+            else None
+        ),
+    )
+
+    matching = 0
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        for timestamp, (id, kind, dest, position, direction, times, stops) in jobs:
+            clock.now = max(clock.now, timestamp)
+            robot.position = Node(graph, position)
+            robot.direction = direction
+            robot.move_fwd_time, robot.turn_rgt_time, robot.turn_lft_time = times
+            job = Job(
+                id,
+                kind,
+                Node(graph, dest) if dest >= 0 else None,
+                [Node(graph, cell) for cell in stops],
+            )
+            executor.execute(job)
+            matching += job.status == statuses.get(id)
+    elapsed = time.perf_counter() - started
+
+    divergence = None
+    if conn.divergence is not None:
+        index, expected, replayed = conn.divergence
+        divergence = {
+            "command": index,
+            "recorded": expected[0].decode() if expected else None,
+            "replayed": replayed[0].decode(),
+        }
+    return {
+        "jobs": len(jobs),
+        "matching_status": matching,
+        "commands": conn.sent,
+        "recorded_commands": len(commands),
+        "divergence": divergence,
+        "obstacles": len(marked),
+        "recorded_obstacles": obstacles,
+        "trace_seconds": round((last or 0.0) - (first or 0.0), 3),
+        "replay_seconds": round(elapsed, 3),
+        "speedup": round(((last or 0.0) - (first or 0.0)) / max(elapsed, 1e-9), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay a trip trace")
+    parser.add_argument("command", choices=["dump", "replay"])
+    parser.add_argument("trace")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="replay with a recorded option changed, e.g. closed_loop=false",
+    )
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        for kind, timestamp, value in read_trace(args.trace):
+            if kind == MAP:
+                value = "%dx%d" % value[:2]
+            print("%.6f %s %s" % (timestamp, KINDS.get(kind, kind), value))
+    else:
+        overrides = {}
+        for option in args.set:
+            key, value = option.split("=", 1)
+            overrides[key] = json.loads(value)
+        print(json.dumps(replay(args.trace, **overrides), indent=2))
@@ -1,23 +1,70 @@
 #!/usr/bin/env python3
 import RPi.GPIO as GPIO
+import threading
 import time
 
-# GPIO Mode (BOARD / BCM)
-GPIO.setmode(GPIO.BCM)
+from utils.metrics import histogram, timed
 
 TRIGGER_PINS = [18, 17, 12, 16, 20]
 ECHO_PINS = [24, 27, 13, 19, 26]
 RANGE_NAMES = ["left_60", "left_30", "fwd", "rgt_30", "rgt_60"]
 
+# An echo pulse lasts at most ~38 ms, when nothing is in range
+ECHO_TIMEOUT = 0.05
+# Distance reported for a sensor whose echo never came back
+NO_ECHO = float("inf")
+
 
 class Rangefinder:
-    def __init__(self, trigger: int, echo: int):
+    def __init__(
+        self, trigger: int, echo: int, edge: bool = False, timeout: float = ECHO_TIMEOUT
+    ):
         self.trigger = trigger
         self.echo = echo
+        self.timeout = timeout
+        self.latency = histogram(
+            "rangefinder_ping_seconds",
+            "Time of a single rangefinder ping",
+            trigger=trigger,
+        )
         GPIO.setup(self.trigger, GPIO.OUT)
         GPIO.setup(self.echo, GPIO.IN)
 
-    def get_distance(self) -> float:
+        # In edge mode the echo is timed by GPIO interrupts instead of
+        # spinning on the pin, so waiting for it does not load the CPU
+        self.edge = edge
+        if edge:
+            self.start_time = None
+            self.stop_time = None
+            # Set by fire(), edges that come at any other time are ignored
+            self.armed = False
+            self.edge_lock = threading.Lock()
+            self.echo_done = threading.Event()
+            GPIO.add_event_detect(self.echo, GPIO.BOTH, callback=self.on_echo_edge)
+
+    def on_echo_edge(self, channel: int):
+        # The edge is told by its order after fire(), not by reading the
+        # pin again: a short echo from a close wall can be over before the
+        # callback of its rising edge runs
+        now = time.perf_counter()
+        with self.edge_lock:
+            if not self.armed:
+                return
+            if self.start_time is None:
+                self.start_time = now
+            else:
+                self.stop_time = now
+                self.armed = False
+                self.echo_done.set()
+
+    def fire(self):
+        if self.edge:
+            with self.edge_lock:
+                self.start_time = None
+                self.stop_time = None
+                self.armed = True
+                self.echo_done.clear()
+
         # set Trigger to HIGH
         GPIO.output(self.trigger, True)
 
@@ -25,16 +72,27 @@ class Rangefinder:
         time.sleep(0.00001)
         GPIO.output(self.trigger, False)
 
-        start_time = time.time()
-        stop_time = time.time()
-
-        # save start_time
-        while GPIO.input(self.echo) == 0:
-            start_time = time.time()
-
-        # save time of arrival
-        while GPIO.input(self.echo) == 1:
-            stop_time = time.time()
+    def wait_echo(self, deadline: float) -> float:
+        if self.edge:
+            if not self.echo_done.wait(max(0.0, deadline - time.perf_counter())):
+                return NO_ECHO
+            start_time = self.start_time
+            stop_time = self.stop_time
+        else:
+            start_time = time.perf_counter()
+            stop_time = start_time
+
+            # save start_time
+            while GPIO.input(self.echo) == 0:
+                start_time = time.perf_counter()
+                if start_time > deadline:
+                    return NO_ECHO
+
+            # save time of arrival
+            while GPIO.input(self.echo) == 1:
+                stop_time = time.perf_counter()
+                if stop_time > deadline:
+                    return NO_ECHO
 
         # time difference between start and arrival
         TimeElapsed = stop_time - start_time
@@ -44,6 +102,77 @@ class Rangefinder:
 
         return distance
 
+    def get_distance(self) -> float:
+        with self.latency.time():
+            self.fire()
+            return self.wait_echo(time.perf_counter() + self.timeout)
+
+
+class RangefinderArray:
+    def __init__(self, rangefinders: dict[str, Rangefinder]):
+        self.rangefinders = rangefinders
+
+    @timed("rangefinder_array_seconds", "Time of one ping of the rangefinder array")
+    def get_distances(self, names: list[str] = None) -> dict[str, float]:
+        if names is None:
+            names = list(self.rangefinders)
+        sensors = [(name, self.rangefinders[name]) for name in names]
+        pending = [
+            (name, rangefinder) for name, rangefinder in sensors if not rangefinder.edge
+        ]
+
+        # Fire all triggers together, the sensors point in different
+        # directions so their echoes do not interfere
+        fired = time.perf_counter()
+        for _, rangefinder in sensors:
+            if rangefinder.edge:
+                rangefinder.fire()
+        for _, rangefinder in pending:
+            GPIO.output(rangefinder.trigger, True)
+        time.sleep(0.00001)
+        for _, rangefinder in pending:
+            GPIO.output(rangefinder.trigger, False)
+
+        # Time every polled echo pin in a single loop. The loop keeps the
+        # GIL busy, so edge mode is best used for all sensors or for none
+        start_times = {}
+        stop_times = {}
+        deadline = time.perf_counter() + ECHO_TIMEOUT
+        while pending:
+            now = time.perf_counter()
+            if now > deadline:
+                break
+            waiting = []
+            for name, rangefinder in pending:
+                level = GPIO.input(rangefinder.echo)
+                if name not in start_times:
+                    if level == 1:
+                        start_times[name] = now
+                    waiting.append((name, rangefinder))
+                elif level == 0:
+                    stop_times[name] = now
+                else:
+                    waiting.append((name, rangefinder))
+            pending = waiting
+
+        # Each sensor records its own ping like get_distance does, from the
+        # triggers to its echo ending, or to the deadline without one
+        distances = {}
+        for name, rangefinder in sensors:
+            if rangefinder.edge:
+                distance = rangefinder.wait_echo(deadline)
+                stop_time = rangefinder.stop_time
+            elif name in stop_times:
+                stop_time = stop_times[name]
+                distance = (stop_time - start_times[name]) * 34300 / 2
+            else:
+                distance = NO_ECHO
+            if distance == NO_ECHO:
+                stop_time = deadline
+            rangefinder.latency.record(stop_time - fired)
+            distances[name] = distance
+        return distances
+
 
 # set GPIO Pins
 # GPIO_TRIGGER = 18
@@ -54,10 +183,13 @@ class Rangefinder:
 # GPIO.setup(GPIO_ECHO, GPIO.IN)
 
 if __name__ == "__main__":
+    # GPIO Mode (BOARD / BCM), set by whoever owns the pins
+    GPIO.setmode(GPIO.BCM)
     try:
         rangefinders = {}
         for trigger, echo, name in zip(TRIGGER_PINS, ECHO_PINS, RANGE_NAMES):
             rangefinders[name] = Rangefinder(trigger, echo)
+        array = RangefinderArray(rangefinders)
         while True:
             start = time.time()
             dist = [
@@ -66,6 +198,13 @@ if __name__ == "__main__":
             ]
             print(f"Measured Distances: {dist}")
             print(round(time.time() - start, 4))
+            start = time.time()
+            dist = [
+                (key, round(distance, 3))
+                for key, distance in array.get_distances().items()
+            ]
+            print(f"Measured Distances (array): {dist}")
+            print(round(time.time() - start, 4))
             time.sleep(3)
 
         # Reset by pressing CTRL + C